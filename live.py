@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta
+import warnings
+import pandas as pd
+from pandas import DataFrame
+import boto3
+import os
+import json
+from web3 import Web3
+
+warnings.filterwarnings("ignore")
+
+from src.data.liquidations import get_liquidations_params
+from src.data.prices import get_daily_prices, get_hourly_prices
+from src.data.balances import get_user_balances, _is_user_collateral_enabled
+from src.data.reserves import get_reserves_data
+from src.prices_volatility.volatility_estimation import (
+    preprocess_prices_for_fitting,
+    fit_multivariate_normal_distribution,
+    generate_prices_correlations,
+)
+from src.live.live_tracking import LiveTrajectoryTracker, resolve_price_feeds
+
+
+# Run Parameters
+# `snapshot_day` is the last complete day available in the data API and
+# `start_block` the first block after it: the blocks in between are replayed
+# before following the chain head. Point NODE_PROVIDER to a local anvil fork
+# to test against a fixed chain. Only blocks with `confirmations` blocks on
+# top of them are processed.
+users_path = "try/live_users.txt"
+snapshot_day = datetime(2024, 4, 5)
+start_block = 19594766
+vol_estimation_nb_days = 62
+delta_t = 1 / 365
+confirmations = 2
+
+
+print("Starting Live Job...")
+
+w3 = Web3(Web3.HTTPProvider(os.environ["NODE_PROVIDER"]))
+
+with open("src/abi/pool.abi") as file:
+    pool_abi = json.load(file)
+with open("src/abi/oracle.abi") as file:
+    oracle_abi = json.load(file)
+with open("src/abi/aggregator.abi") as file:
+    aggregator_abi = json.load(file)
+
+pool = w3.eth.contract(
+    address="0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2", abi=pool_abi
+)
+oracle = w3.eth.contract(
+    address="0x54586bE62E3c3580375aE3723C145253060Ca0C2", abi=oracle_abi
+)
+
+client_s3 = boto3.client(
+    "s3",
+    endpoint_url="https://" + "minio-simple.lab.groupe-genes.fr",
+    aws_access_key_id=os.environ["ACCESS_KEY_ID"],
+    aws_secret_access_key=os.environ["SECRET_ACCESS_KEY"],
+    verify=False,
+)
+
+liquidations_params = get_liquidations_params(client_s3=client_s3)
+
+with open(users_path) as file:
+    users = [line.strip() for line in file if line.strip()]
+
+# Reserves, prices and volatility as of the snapshot
+reserves = get_reserves_data(day=snapshot_day)
+prices = get_hourly_prices(day=snapshot_day)
+processed_prices = preprocess_prices_for_fitting(
+    prices=get_daily_prices(
+        start=snapshot_day - timedelta(days=vol_estimation_nb_days),
+        stop=snapshot_day,
+    )
+)
+Sigma = fit_multivariate_normal_distribution(brownian_motions=processed_prices.values)
+volatility = generate_prices_correlations(
+    corr_matrix=Sigma, reserves_list=processed_prices.columns.tolist()
+)
+
+# Tracked users balances and collateral flags
+users_balances = DataFrame()
+for user in users:
+    user_balances = get_user_balances(user=user, day=snapshot_day)
+    if user_balances.empty:
+        continue
+    user_balances["user_address"] = user
+    user_balances["collateral_enabled"] = [
+        _is_user_collateral_enabled(
+            pool=pool,
+            user=user,
+            asset=asset,
+            block_number=start_block,
+            liquidation_params=liquidations_params,
+        )
+        for asset in user_balances.underlyingAsset
+    ]
+    users_balances = pd.concat((users_balances, user_balances))
+
+# Chainlink aggregators behind the Aave oracle sources, an aggregator can
+# drive the price of several assets and an asset can depend on several
+# aggregators (adapters)
+aggregators = {}
+for asset in reserves.underlyingAsset:
+    source = oracle.functions.getSourceOfAsset(
+        Web3.to_checksum_address(asset)
+    ).call()
+    asset_aggregators = resolve_price_feeds(
+        w3=w3, source=source, aggregator_abi=aggregator_abi
+    )
+    if not asset_aggregators:
+        print(f"No Chainlink aggregator for {asset}, price will not be updated")
+    for aggregator in asset_aggregators:
+        aggregators.setdefault(aggregator, []).append(asset)
+
+tracker = LiveTrajectoryTracker(
+    w3=w3,
+    pool=pool,
+    users_balances=users_balances,
+    reserves=reserves,
+    prices=prices,
+    liquidation_params=liquidations_params,
+    volatility=volatility,
+    detla_t=delta_t,
+    start_block=start_block,
+    oracle=oracle,
+    aggregators=aggregators,
+    aggregator_abi=aggregator_abi,
+)
+
+
+def print_updates(updates: DataFrame):
+    for _, row in updates.iterrows():
+        print(
+            f"Block {row.BlockNumber} - {row.user_address}: "
+            f"hf={row.hf:.4f}, proba_p1={row.proba_p1:.4f}"
+        )
+
+
+tracker.follow(confirmations=confirmations, callback=print_updates)
@@ -28,43 +28,69 @@ from src.prices_volatility.volatility_estimation import (
 from src.liquidation_proba.liquidation_estimation import (
     compute_liquidation_proba_trajectory,
     compute_health_factor_trajectory,
+    compute_liquidation_sensitivities,
 )
+from src.utils.stage_cache import StageCache
+from src.store.trajectory_store import TrajectoryStore
 
 
 # Run Parameters
 output_path = "try/liquidation_trajectories/"
+cache_path = "try/cache/"
+# Local trajectory store (requires duckdb), None to disable. In sharded
+# mode it must be on the filesystem shared by the nodes, like `queue_path`
+store_path = None
 start = datetime(2024, 4, 5)
 stop = datetime(2024, 4, 5)
 vol_estimation_nb_days = 62
 delta_t = 1 / 365
+# The proba_p1 / proba_p2 / user_std columns and the sensitivities use
+# `delta_t`, the other horizons add suffixed columns (e.g. proba_p1_7d)
+horizons = [1 / (365 * 24), delta_t, 7 / 365]
+horizons_layout = "wide"
 
 
-print("Starting Job...")
+def connect():
+    """Return the Aave Pool contract and the S3 client."""
+    w3 = Web3(Web3.HTTPProvider(os.environ["NODE_PROVIDER"]))
 
-w3 = Web3(Web3.HTTPProvider(os.environ["NODE_PROVIDER"]))
+    with open("src/abi/pool.abi") as file:
+        pool_abi = json.load(file)
 
-with open("src/abi/pool.abi") as file:
-    pool_abi = json.load(file)
-
-pool = w3.eth.contract(
-    address="0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2", abi=pool_abi
-)
+    pool = w3.eth.contract(
+        address="0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2", abi=pool_abi
+    )
 
-client_s3 = boto3.client(
-    "s3",
-    endpoint_url="https://" + "minio-simple.lab.groupe-genes.fr",
-    aws_access_key_id=os.environ["ACCESS_KEY_ID"],
-    aws_secret_access_key=os.environ["SECRET_ACCESS_KEY"],
-    verify=False,
-)
+    client_s3 = boto3.client(
+        "s3",
+        endpoint_url="https://" + "minio-simple.lab.groupe-genes.fr",
+        aws_access_key_id=os.environ["ACCESS_KEY_ID"],
+        aws_secret_access_key=os.environ["SECRET_ACCESS_KEY"],
+        verify=False,
+    )
+    return pool, client_s3
 
 
-liquidations_params = get_liquidations_params(client_s3=client_s3)
+def user_shard(user: str, n_shards: int) -> int:
+    """Stable shard of a user address, identical on every node."""
+    return int(user, 16) % n_shards
 
-day = start
-while day <= stop:
-    print("***Treating day: ", day, "***")
 
+def process_day(
+    day: datetime,
+    pool,
+    liquidations_params: DataFrame,
+    cache: StageCache,
+    shard: int = 0,
+    n_shards: int = 1,
+    heartbeat=None,
+):
+    """
+    Compute the liquidation trajectories and balances of the users liquidated
+    on `day`, restricted to the users of `shard` out of `n_shards`.
+    `heartbeat` is called before treating each user and stops the day by
+    raising, e.g. when the work queue lease was lost.
+    """
     # Reserves and raw prices data
     reserves = get_reserves_data(day=day)
     liquidation_day_prices = get_hourly_prices(day=day)
@@ -74,11 +100,15 @@ while day <= stop:
     )
 
     # Compute prices volatility
-    processed_prices = preprocess_prices_for_fitting(
-        prices=volatility_estimation_prices
+    processed_prices = cache.run(
+        "prices_preprocessing",
+        preprocess_prices_for_fitting,
+        prices=volatility_estimation_prices,
     )
-    Sigma = fit_multivariate_normal_distribution(
-        brownian_motions=processed_prices.values
+    Sigma = cache.run(
+        "sigma_fit",
+        fit_multivariate_normal_distribution,
+        brownian_motions=processed_prices.values,
     )
     volatility = generate_prices_correlations(
         corr_matrix=Sigma, reserves_list=processed_prices.columns.tolist()
@@ -93,9 +123,17 @@ while day <= stop:
         liquidated_users_list = liquidations_day.user.unique().tolist()
     else:
         liquidated_users_list = []
-    
+    if n_shards > 1:
+        liquidated_users_list = [
+            user
+            for user in liquidated_users_list
+            if user_shard(user=user, n_shards=n_shards) == shard
+        ]
+
     for liquidated_user in liquidated_users_list:
         print("User is: ", liquidated_user)
+        if heartbeat is not None:
+            heartbeat()
         liquidations = liquidations_day[liquidations_day.user == liquidated_user]
         user_initial_balance = get_user_balances(
             user=liquidated_user, day=day - timedelta(days=1)
@@ -109,14 +147,18 @@ while day <= stop:
             liquidation_params=liquidations_params,
         )
 
-        balances = compute_user_balances(
+        balances = cache.run(
+            "user_balances",
+            compute_user_balances,
             user_initial_balance=user_initial_balance,
             day_prices=liquidation_day_prices,
             user_events=user_events,
             reserves_data_updated=reserves_data_updated,
             reserves=reserves,
         )
-        balances = process_user_balances(
+        balances = cache.run(
+            "collateral_flags",
+            process_user_balances,
             user=liquidated_user,
             user_balances=balances,
             reserves=reserves,
@@ -124,19 +166,53 @@ while day <= stop:
             liquidation_params=liquidations_params,
         )
 
-        probas = compute_liquidation_proba_trajectory(
-            user_balances=balances, volatility=volatility, detla_t=delta_t
+        probas = cache.run(
+            "trajectories",
+            compute_liquidation_proba_trajectory,
+            user_balances=balances,
+            volatility=volatility,
+            detla_t=delta_t,
+            horizons=horizons,
+            layout=horizons_layout,
+        )
+        hf = cache.run(
+            "health_factor",
+            compute_health_factor_trajectory,
+            user_balances=balances,
+        )
+        sensitivities = cache.run(
+            "sensitivities",
+            compute_liquidation_sensitivities,
+            user_balances=balances,
+            volatility=volatility,
+            detla_t=delta_t,
+        )
+        balances = balances.merge(
+            sensitivities,
+            how="left",
+            on=["BlockNumber", "Timestamp", "underlyingAsset"],
         )
-        hf = compute_health_factor_trajectory(user_balances=balances)
         trajectory = probas.merge(hf, how="left", on=["BlockNumber", "Timestamp"])
         trajectory["user_address"] = liquidated_user
         balances["user_address"] = liquidated_user
         day_trajectories = pd.concat((day_trajectories, trajectory))
         day_user_balances = pd.concat((day_user_balances, balances))
 
+    return day_trajectories, day_user_balances, volatility
+
+
+def save_day_outputs(
+    client_s3,
+    day: datetime,
+    day_trajectories: DataFrame,
+    day_user_balances: DataFrame,
+    volatility: DataFrame,
+    store: TrajectoryStore = None,
+):
+    day_str = day.strftime("%Y-%m-%d")
+
     buffer = io.StringIO()
     day_trajectories.to_csv(buffer, index=False)
-    day_str = day.strftime("%Y-%m-%d")
     client_s3.put_object(
         Bucket="projet-datalab-group-jprat",
         Key=output_path
@@ -146,7 +222,6 @@ while day <= stop:
 
     buffer = io.StringIO()
     day_user_balances.to_csv(buffer, index=False)
-    day_str = day.strftime("%Y-%m-%d")
     client_s3.put_object(
         Bucket="projet-datalab-group-jprat",
         Key=output_path
@@ -156,7 +231,6 @@ while day <= stop:
 
     buffer = io.StringIO()
     volatility.to_csv(buffer, index=False)
-    day_str = day.strftime("%Y-%m-%d")
     client_s3.put_object(
         Bucket="projet-datalab-group-jprat",
         Key=output_path
@@ -164,4 +238,38 @@ while day <= stop:
         Body=buffer.getvalue(),
     )
 
-    day += timedelta(days=1)
+    if store is not None:
+        store.ingest_day(
+            day=day,
+            day_trajectories=day_trajectories,
+            day_user_balances=day_user_balances,
+        )
+
+
+if __name__ == "__main__":
+    print("Starting Job...")
+
+    pool, client_s3 = connect()
+    liquidations_params = get_liquidations_params(client_s3=client_s3)
+    cache = StageCache(cache_path=cache_path)
+    store = TrajectoryStore(store_path=store_path) if store_path else None
+
+    day = start
+    while day <= stop:
+        print("***Treating day: ", day, "***")
+        day_trajectories, day_user_balances, volatility = process_day(
+            day=day,
+            pool=pool,
+            liquidations_params=liquidations_params,
+            cache=cache,
+        )
+        cache.report()
+        save_day_outputs(
+            client_s3=client_s3,
+            day=day,
+            day_trajectories=day_trajectories,
+            day_user_balances=day_user_balances,
+            volatility=volatility,
+            store=store,
+        )
+        day += timedelta(days=1)
@@ -0,0 +1,167 @@
+from datetime import datetime
+import warnings
+import pandas as pd
+from pandas import DataFrame
+import os
+import socket
+import sys
+import time
+
+warnings.filterwarnings("ignore")
+
+from src.data.liquidations import get_liquidations_params
+from src.utils.stage_cache import StageCache
+from src.utils.work_queue import WorkQueue, LeaseLostError
+from src.store.trajectory_store import TrajectoryStore
+from main import cache_path, store_path, connect, process_day, save_day_outputs
+
+
+# Run Parameters
+# `queue_path`, `partial_path` and the `store_path` of main.py must be on a
+# filesystem shared by all the nodes. Run `python sharded.py enqueue` once,
+# then `python sharded.py work` on every node. `python sharded.py requeue`
+# gives the failed units and merges of [start, stop] new attempts.
+queue_path = "try/work_queue/queue.db"
+partial_path = "try/work_queue/partial_outputs/"
+start = datetime(2024, 4, 5)
+stop = datetime(2024, 4, 5)
+n_shards = 8
+lease_timeout = 1800
+max_attempts = 3
+poll_interval = 30
+
+USAGE = "Usage: python sharded.py enqueue|work|requeue|status"
+
+OUTPUTS = ["liquidation_trajectories", "users_balances", "volatility"]
+
+
+def _shard_dir(day: datetime, shard: int) -> str:
+    day_str = day.strftime("%Y-%m-%d")
+    return os.path.join(partial_path, f"snapshot_date={day_str}", f"shard={shard}")
+
+
+def write_partial_outputs(day: datetime, shard: int, outputs: list):
+    shard_dir = _shard_dir(day=day, shard=shard)
+    os.makedirs(shard_dir, exist_ok=True)
+    for name, output in zip(OUTPUTS, outputs):
+        # Write then rename, so that a retried unit overwrites atomically
+        path = os.path.join(shard_dir, f"{name}.csv")
+        tmp_path = path + f".{socket.gethostname()}.{os.getpid()}.tmp"
+        output.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+
+def read_partial_output(day: datetime, shard: int, name: str) -> DataFrame:
+    try:
+        return pd.read_csv(
+            os.path.join(_shard_dir(day=day, shard=shard), f"{name}.csv")
+        )
+    except pd.errors.EmptyDataError:
+        return DataFrame()
+
+
+def merge_day(client_s3, store: TrajectoryStore, day: datetime, n_shards: int):
+    print("***Merging day: ", day, "***")
+    day_trajectories = pd.concat(
+        [
+            read_partial_output(day, shard, "liquidation_trajectories")
+            for shard in range(n_shards)
+        ]
+    )
+    day_user_balances = pd.concat(
+        [read_partial_output(day, shard, "users_balances") for shard in range(n_shards)]
+    )
+    # The volatility only depends on the day
+    volatility = read_partial_output(day, 0, "volatility")
+    save_day_outputs(
+        client_s3=client_s3,
+        day=day,
+        day_trajectories=day_trajectories,
+        day_user_balances=day_user_balances,
+        volatility=volatility,
+        store=store,
+    )
+
+
+def work(queue: WorkQueue):
+    worker = f"{socket.gethostname()}-{os.getpid()}"
+    pool, client_s3 = connect()
+    liquidations_params = get_liquidations_params(client_s3=client_s3)
+    cache = StageCache(cache_path=cache_path)
+    store = TrajectoryStore(store_path=store_path) if store_path else None
+
+    while True:
+        merge = queue.lease_merge(worker=worker)
+        if merge is not None:
+            day, day_n_shards = merge
+            try:
+                merge_day(
+                    client_s3=client_s3, store=store, day=day, n_shards=day_n_shards
+                )
+            except Exception as e:
+                print(f"Merge failed: {e}")
+                queue.release_merge(worker=worker, day=day)
+                continue
+            queue.complete_merge(worker=worker, day=day)
+            continue
+
+        unit = queue.lease(worker=worker)
+        if unit is None:
+            status = queue.status()
+            # Days with failed units are never merged
+            if set(status["units"]) <= {"done", "failed"} and (
+                "merging" not in status["days"]
+            ):
+                print("No work left: ", status)
+                return
+            time.sleep(poll_interval)
+            continue
+
+        day, shard, unit_n_shards = unit
+        print(f"***Treating day: {day}, shard {shard}/{unit_n_shards}***")
+
+        def heartbeat():
+            if not queue.heartbeat(worker=worker, day=day, shard=shard):
+                raise LeaseLostError(f"Lease of {day}, shard {shard} was lost")
+
+        try:
+            outputs = process_day(
+                day=day,
+                pool=pool,
+                liquidations_params=liquidations_params,
+                cache=cache,
+                shard=shard,
+                n_shards=unit_n_shards,
+                heartbeat=heartbeat,
+            )
+            cache.report()
+            # Do not overwrite the outputs of the worker owning the unit now
+            heartbeat()
+        except LeaseLostError as e:
+            print(f"Unit abandoned: {e}")
+            continue
+        except Exception as e:
+            print(f"Unit failed: {e}")
+            queue.release(worker=worker, day=day, shard=shard)
+            continue
+        write_partial_outputs(day=day, shard=shard, outputs=outputs)
+        if not queue.complete(worker=worker, day=day, shard=shard):
+            print(f"Lease of {day}, shard {shard} was lost before completion")
+
+
+if __name__ == "__main__":
+    verb = sys.argv[1] if len(sys.argv) == 2 else None
+    if verb not in ["enqueue", "work", "requeue", "status"]:
+        print(USAGE)
+        sys.exit(1)
+    queue = WorkQueue(
+        db_path=queue_path, lease_timeout=lease_timeout, max_attempts=max_attempts
+    )
+    if verb == "enqueue":
+        queue.enqueue(start=start, stop=stop, n_shards=n_shards)
+    elif verb == "requeue":
+        print("Requeued: ", queue.requeue(start=start, stop=stop))
+    elif verb == "work":
+        work(queue=queue)
+    if verb != "work":
+        print("Queued units: ", queue.status())
@@ -82,18 +82,25 @@ def get_user_events(user: str, day: datetime):
     return all_user_events.sort_values("blockNumber")
 
 
+def _liquidation_withdraw_amount(colAmount, liquidationBonus, liquidationProtocolFee):
+    return (
+        colAmount
+        + (colAmount - colAmount / (liquidationBonus * 1e-4))
+        * liquidationProtocolFee
+        * 1e-4
+    )
+
+
 def add_liquidation_to_user_events(user_events, liquidation_events, liquidation_params):
     liquidation_events_ = liquidation_events.merge(
         liquidation_params, left_on="collateralAsset", right_on="reserve"
     )
     for _, liq in liquidation_events_.iterrows():
         block = liq["blockNumber"]
-        colAmount = liq["liquidatedCollateralAmount"]
-        withdraw_amount = (
-            colAmount
-            + (colAmount - colAmount / (liq["liquidationBonus"] * 1e-4))
-            * liq["liquidationProtocolFee"]
-            * 1e-4
+        withdraw_amount = _liquidation_withdraw_amount(
+            colAmount=liq["liquidatedCollateralAmount"],
+            liquidationBonus=liq["liquidationBonus"],
+            liquidationProtocolFee=liq["liquidationProtocolFee"],
         )
         withdraw_reserve = liq["collateralAsset"]
         repay_amount = liq["debtToCover"]
@@ -202,6 +209,10 @@ def compute_user_balances(
                 amount * liquidityIndex
             )
 
+    return _add_usd_balances(balances)
+
+
+def _add_usd_balances(balances: DataFrame) -> DataFrame:
     balances["currentATokenBalanceUSD"] = (
         balances.currentATokenBalance / 10**balances.decimals * balances.Price * 1e-8
     )
@@ -224,6 +235,15 @@ def compute_user_balances(
     return balances
 
 
+def _compute_a(balances: DataFrame):
+    return (
+        balances.currentVariableDebtUSD
+        - balances.reserveLiquidationThreshold
+        * balances.currentATokenBalanceUSD
+        * balances.collateral_enabled
+    )
+
+
 def _is_user_collateral_enabled(
     pool: contract,
     user: str,
@@ -309,12 +329,7 @@ def process_user_balances(
     balances.reserveLiquidationThreshold = balances.reserveLiquidationThreshold * 1e-4
 
     # Compute the a value
-    balances["a"] = (
-        balances.currentVariableDebtUSD
-        - balances.reserveLiquidationThreshold
-        * balances.currentATokenBalanceUSD
-        * balances.collateral_enabled
-    )
+    balances["a"] = _compute_a(balances)
 
     select_columns = [
         "BlockNumber",
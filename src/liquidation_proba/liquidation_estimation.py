@@ -1,3 +1,4 @@
+import pandas as pd
 from pandas import DataFrame
 import numpy as np
 from scipy.stats import norm
@@ -62,29 +63,113 @@ def compute_liquidation_proba(
     return np.sqrt(all_combinaisons.value.sum()), user_balances.a.sum(), norm.cdf(q_value)
 
 
+def _horizon_label(detla_t: float) -> str:
+    """
+    Readable label of a horizon in years, e.g. "30m", "1h", "1d" or "7d".
+    Raises a ValueError if the horizon is not a whole number of minutes.
+    """
+    minutes = detla_t * 365 * 24 * 60
+    for unit, unit_minutes in [("d", 24 * 60), ("h", 60), ("m", 1)]:
+        count = round(minutes / unit_minutes)
+        if count > 0 and np.isclose(minutes / unit_minutes, count):
+            return f"{count}{unit}"
+    raise ValueError(
+        f"Horizon {detla_t} years is not a whole number of minutes, days or hours"
+    )
+
+
 def compute_liquidation_proba_trajectory(
-    user_balances: DataFrame, volatility: DataFrame, detla_t: float
+    user_balances: DataFrame,
+    volatility: DataFrame,
+    detla_t: float,
+    horizons: list = None,
+    layout: str = "wide",
 ) -> DataFrame:
-    probas = user_balances.groupby(["BlockNumber", "Timestamp"]).apply(
-        lambda x: compute_liquidation_proba(x, volatility, detla_t)
-    )
-    probas = probas.reset_index().rename(columns={0: "value"})
-    probas["user_std"] = probas["value"].str[0]
-    probas["user_a"] = probas["value"].str[1]
-    probas["proba_p1"] = probas["value"].str[2]
-    # probas = probas.reset_index().rename(columns={0: "proba_p1"})
-    probas["proba_p2"] = np.minimum(1, 2 * probas.proba_p1)
-    return probas
+    """
+    Compute the liquidation probabilities of the user at every block, for the
+    base horizon `detla_t` and optionally for several `horizons`. Since a'Ca
+    only scales with the horizon, it is computed once per block and reused
+    for every horizon.
+
+    Args:
+        user_balances (DataFrame): Output from `process_user_balances()` function
+        volatility (DataFrame): Output from `generate_prices_correlations()`
+        detla_t (float): The base time horizon, in years
+        horizons (list): Optional time horizons, in years, containing `detla_t`
+        layout (str): With `horizons`, "wide" adds the user_std, proba_p1 and
+            proba_p2 columns of the other horizons suffixed with their label
+            (e.g. proba_p1_7d), "long" returns one row per block and horizon
+            with the "horizon" and "horizon_years" columns.
+
+    Returns:
+        (DataFrame): The BlockNumber, Timestamp, user_std, user_a, proba_p1
+            and proba_p2 columns, for the base horizon except in the long
+            layout where they refer to the horizon of the row.
+    """
+    if horizons is None:
+        horizons = [detla_t]
+    elif not np.any(np.isclose(horizons, detla_t)):
+        raise ValueError(f"detla_t={detla_t} is not one of the horizons {horizons}")
+    if layout not in ["wide", "long"]:
+        raise ValueError(f"Unknown layout {layout}, expected 'wide' or 'long'")
+
+    keys = ["BlockNumber", "Timestamp"]
+    columns = ["user_std", "user_a", "proba_p1", "proba_p2"]
+    exposure = _exposure_matrix(user_balances)
+    A = exposure.values.astype(float)
+    C = _covariance_matrix(volatility, exposure.columns.tolist())
+    variance = _exposure_variance(A, C)
+    user_a = A.sum(axis=1)
+
+    probas = {}
+    for horizon in horizons:
+        user_std = np.sqrt(variance * horizon)
+        proba_p1 = norm.cdf(user_a / user_std)
+        probas[horizon] = DataFrame(
+            {
+                "user_std": user_std,
+                "user_a": user_a,
+                "proba_p1": proba_p1,
+                "proba_p2": np.minimum(1, 2 * proba_p1),
+            },
+            index=exposure.index,
+        )
+
+    if layout == "long":
+        for horizon, proba in probas.items():
+            proba.insert(0, "horizon", _horizon_label(horizon))
+            proba.insert(1, "horizon_years", horizon)
+        return pd.concat(probas.values()).reset_index()
+
+    base = next(h for h in horizons if np.isclose(h, detla_t))
+    wide = probas[base]
+    for horizon, proba in probas.items():
+        if horizon == base:
+            continue
+        wide = wide.join(
+            proba[["user_std", "proba_p1", "proba_p2"]].add_suffix(
+                f"_{_horizon_label(horizon)}"
+            )
+        )
+    return wide.reset_index()[keys + columns + wide.columns[len(columns):].tolist()]
 
 
 def compute_health_factor_trajectory(user_balances: DataFrame) -> DataFrame:
-    balances_ = user_balances.copy()
+    return _health_factor(user_balances, keys=["BlockNumber", "Timestamp"])
+
+
+def _health_factor(balances: DataFrame, keys: list) -> DataFrame:
+    """
+    The HF of each group of `keys` (e.g. one block of a user, or one user at
+    a block), infinite when there is no debt.
+    """
+    balances_ = balances.copy()
     balances_["hf_numerator"] = (
         balances_.currentATokenBalanceUSD
         * balances_.reserveLiquidationThreshold
         * balances_.collateral_enabled
     )
-    balances_ = balances_.groupby(["BlockNumber", "Timestamp"], as_index=False).agg(
+    balances_ = balances_.groupby(keys, as_index=False).agg(
         {"hf_numerator": "sum", "currentVariableDebtUSD": "sum"}
     )
     balances_["hf"] = np.where(
@@ -97,4 +182,126 @@ def compute_health_factor_trajectory(user_balances: DataFrame) -> DataFrame:
             balances_.currentVariableDebtUSD,
         ),
     )
-    return balances_[["BlockNumber", "Timestamp", "hf"]]
+    return balances_[keys + ["hf"]]
+
+
+def _covariance_matrix(volatility: DataFrame, assets: list) -> np.ndarray:
+    """
+    Build the annualised covariance matrix C_ij = std_i * std_j * rho_ij
+    restricted and ordered on `assets`, from the output of
+    `generate_prices_correlations()` (stds on the diagonal, correlations
+    elsewhere). Assets without volatility data get zero entries, matching
+    `compute_liquidation_proba()` where their NaN terms are skipped by the sum.
+    """
+    sigma = (
+        volatility["rho"]
+        .unstack("pair2")
+        .reindex(index=assets, columns=assets)
+        .values.astype(float)
+    )
+    std = np.diag(sigma).copy()
+    corr = sigma.copy()
+    np.fill_diagonal(corr, 1)
+    return np.nan_to_num(corr * np.outer(std, std))
+
+
+def _exposure_matrix(user_balances: DataFrame) -> DataFrame:
+    """The a values, one row per (BlockNumber, Timestamp), one column per asset."""
+    return user_balances.pivot_table(
+        index=["BlockNumber", "Timestamp"],
+        columns="underlyingAsset",
+        values="a",
+        aggfunc="sum",
+        fill_value=0,
+    )
+
+
+def _exposure_variance(A: np.ndarray, C: np.ndarray) -> np.ndarray:
+    """The annualised a'Ca of each row of the exposure matrix A."""
+    return np.sum((A @ C) * A, axis=1)
+
+
+def _exposure_proba(A: np.ndarray, C: np.ndarray, detla_t: float):
+    """
+    Vectorized `compute_liquidation_proba()` over the rows of the exposure
+    matrix A (one row per user or block, one column per asset of C).
+    """
+    std = np.sqrt(_exposure_variance(A, C) * detla_t)
+    a_sum = A.sum(axis=1)
+    return std, a_sum, norm.cdf(a_sum / std)
+
+
+def compute_liquidation_sensitivities(
+    user_balances: DataFrame, volatility: DataFrame, detla_t: float
+) -> DataFrame:
+    """
+    Closed-form gradient of proba_p1 = Phi(sum(a) / sqrt(a'Ca * detla_t)) for
+    every block and asset of the user, computed in one vectorized pass.
+
+    With m = sum(a), V = a'Ca * detla_t and q = m / sqrt(V):
+        dp/da_k = phi(q) / sqrt(V) * (1 - m * (Ca)_k * detla_t / V)
+    and, since a_k = debt_k - LT_k * collateral_k * collateral_enabled_k,
+    the other gradients follow by the chain rule:
+        dp/dlog(price_k) = dp/da_k * a_k  (both USD balances scale with price)
+        dp/dcollateral_k = -dp/da_k * LT_k * collateral_enabled_k
+        dp/ddebt_k = dp/da_k
+        dp/dLT_k = -dp/da_k * collateral_k * collateral_enabled_k
+
+    Args:
+        user_balances (DataFrame): Output from `process_user_balances()` function
+        volatility (DataFrame): Output from `generate_prices_correlations()`
+        detla_t (float): The time horizon, in years
+
+    Returns:
+        (DataFrame): One row per (BlockNumber, Timestamp, underlyingAsset)
+            with the columns dproba_da, dproba_dlogprice, dproba_dcollateral,
+            dproba_ddebt and dproba_dlt.
+    """
+    keys = ["BlockNumber", "Timestamp"]
+    exposure = _exposure_matrix(user_balances)
+    assets = exposure.columns.tolist()
+    A = exposure.values.astype(float)
+    C = _covariance_matrix(volatility, assets) * detla_t
+
+    CA = A @ C
+    V = np.sum(CA * A, axis=1)
+    std = np.sqrt(V)
+    m = A.sum(axis=1)
+    q = m / std
+    dp_da = (norm.pdf(q) / std)[:, None] * (1 - m[:, None] * CA / V[:, None])
+
+    gradient = (
+        DataFrame(dp_da, index=exposure.index, columns=assets)
+        .reset_index()
+        .melt(id_vars=keys, var_name="underlyingAsset", value_name="dproba_da")
+    )
+    sensitivities = user_balances[
+        keys
+        + [
+            "underlyingAsset",
+            "collateral_enabled",
+            "currentATokenBalanceUSD",
+            "reserveLiquidationThreshold",
+            "a",
+        ]
+    ].merge(gradient, how="left", on=keys + ["underlyingAsset"])
+    enabled = sensitivities.collateral_enabled.astype(float)
+    sensitivities["dproba_dlogprice"] = sensitivities.dproba_da * sensitivities.a
+    sensitivities["dproba_dcollateral"] = (
+        -sensitivities.dproba_da * sensitivities.reserveLiquidationThreshold * enabled
+    )
+    sensitivities["dproba_ddebt"] = sensitivities.dproba_da
+    sensitivities["dproba_dlt"] = (
+        -sensitivities.dproba_da * sensitivities.currentATokenBalanceUSD * enabled
+    )
+    return sensitivities[
+        keys
+        + [
+            "underlyingAsset",
+            "dproba_da",
+            "dproba_dlogprice",
+            "dproba_dcollateral",
+            "dproba_ddebt",
+            "dproba_dlt",
+        ]
+    ]
@@ -0,0 +1,476 @@
+import time
+import pandas as pd
+from pandas import DataFrame
+import numpy as np
+from requests.exceptions import RequestException
+from web3 import Web3, contract
+from web3.exceptions import Web3Exception
+
+from src.data.balances import (
+    _add_usd_balances,
+    _compute_a,
+    _liquidation_withdraw_amount,
+)
+from src.liquidation_proba.liquidation_estimation import (
+    _covariance_matrix,
+    _exposure_proba,
+    _health_factor,
+)
+
+
+POOL_EVENTS = [
+    "Supply",
+    "Borrow",
+    "Withdraw",
+    "Repay",
+    "LiquidationCall",
+    "ReserveDataUpdated",
+    "ReserveUsedAsCollateralEnabled",
+    "ReserveUsedAsCollateralDisabled",
+]
+
+
+def _event_topics(abi: list, events: list) -> dict:
+    """Map the topic0 of each event of `events` to its (deduplicated) abi."""
+    topics = {}
+    for entry in abi:
+        if entry["type"] != "event" or entry["name"] not in events:
+            continue
+        signature = "{}({})".format(
+            entry["name"], ",".join(arg["type"] for arg in entry["inputs"])
+        )
+        topics[bytes(Web3.keccak(text=signature))] = entry
+    return topics
+
+
+# Getters of the Chainlink feeds used by the Aave price adapters (CAPO and
+# synchronicity adapters), tried when a source is not a Chainlink proxy
+ADAPTER_FEEDS = [
+    "BASE_TO_USD_AGGREGATOR",
+    "ASSET_TO_USD_AGGREGATOR",
+    "ASSET_TO_PEG",
+    "PEG_TO_BASE",
+    "BASE_TO_PEG",
+]
+
+
+def resolve_price_feeds(w3: Web3, source: str, aggregator_abi: list) -> list:
+    """
+    Return the Chainlink aggregators emitting the AnswerUpdated events that
+    the price of an Aave Oracle `source` depends on.
+    """
+    source_contract = w3.eth.contract(address=source, abi=aggregator_abi)
+    try:
+        return [source_contract.functions.aggregator().call()]
+    except Exception:
+        pass
+    aggregators = []
+    for getter in ADAPTER_FEEDS:
+        try:
+            feed = getattr(source_contract.functions, getter)().call()
+        except Exception:
+            continue
+        aggregators.extend(resolve_price_feeds(w3, feed, aggregator_abi))
+    return aggregators
+
+
+def _with_retries(call, retries: int, wait: float):
+    """Run a node call, retrying it on connection and RPC errors."""
+    for attempt in range(retries):
+        try:
+            return call()
+        except (RequestException, Web3Exception) as e:
+            if attempt + 1 == retries:
+                raise
+            print(f"Node call failed ({e}), retrying")
+            time.sleep(wait)
+
+
+class LiveTrajectoryTracker:
+    """
+    Follow new blocks from a Web3 provider (a mainnet node, or a local anvil
+    fork for tests) and keep the balances, HF and proba_p1 of a set of
+    tracked users up to date.
+
+    Balances are kept as scaled balances per (user, asset), so that interest
+    accrual only requires the reserve indexes: ReserveDataUpdated events just
+    update the indexes, and a user is recomputed only when one of its
+    balances, collateral flags or asset prices changes. The per-block cost
+    therefore scales with the number of touched users. The USD conversion,
+    the a value and the probability use the same math as
+    `compute_user_balances()`, `process_user_balances()` and
+    `compute_liquidation_proba()`. aToken BalanceTransfer events are not
+    followed, and the events of reserves listed after the snapshot are
+    skipped.
+
+    Args:
+        w3 (Web3): The Web3 provider
+        pool (web3.contract): The Aave Pool contract
+        users_balances (DataFrame): Concatenated outputs of `get_user_balances()`
+            for the tracked users, with an additional "collateral_enabled" column
+        reserves (DataFrame): The reserves_data dataframe
+        prices (DataFrame): Prices data, the last price of each token is used
+        liquidation_params (DataFrame): DataFrame containing the reserves
+            liquidation bonus and protocol fee
+        volatility (DataFrame): Output from `generate_prices_correlations()`
+        detla_t (float): The time horizon of the probability, in years
+        start_block (int): The first block to process
+        oracle (web3.contract): The Aave Oracle contract
+        aggregators (dict): Maps Chainlink aggregator addresses to the list of
+            assets whose oracle price depends on them. On their AnswerUpdated
+            events, the prices of these assets are re-read from the Aave
+            Oracle at that block, which also covers the adapters (e.g. wstETH
+            or WBTC) combining several feeds.
+        aggregator_abi (list): The abi holding the AnswerUpdated event
+        retries (int): Number of attempts of each node call
+        retry_wait (float): Seconds between two attempts
+    """
+
+    def __init__(
+        self,
+        w3: Web3,
+        pool: contract,
+        users_balances: DataFrame,
+        reserves: DataFrame,
+        prices: DataFrame,
+        liquidation_params: DataFrame,
+        volatility: DataFrame,
+        detla_t: float,
+        start_block: int,
+        oracle: contract = None,
+        aggregators: dict = None,
+        aggregator_abi: list = None,
+        retries: int = 3,
+        retry_wait: float = 1,
+    ):
+        self.w3 = w3
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.pool_address = pool.address
+        self.detla_t = detla_t
+        self.last_block = start_block - 1
+
+        pool_topics = _event_topics(pool.abi, POOL_EVENTS)
+        self.decoders = {
+            topic: getattr(w3.eth.contract(abi=[abi]).events, abi["name"])()
+            for topic, abi in pool_topics.items()
+        }
+        self.oracle = oracle
+        self.aggregators = {
+            address.lower(): [asset.lower() for asset in assets]
+            for address, assets in (aggregators or {}).items()
+        }
+        self.stale_prices = set()
+        if self.aggregators:
+            for topic, abi in _event_topics(aggregator_abi, ["AnswerUpdated"]).items():
+                self.decoders[topic] = getattr(
+                    w3.eth.contract(abi=[abi]).events, abi["name"]
+                )()
+
+        # Reserves state: indexes, liquidation threshold and price
+        last_prices = prices.sort_values("Timestamp").groupby("UnderlyingToken").last()
+        self.reserves = reserves[
+            ["underlyingAsset", "name", "decimals", "reserveLiquidationThreshold"]
+        ].copy()
+        self.reserves["liquidityIndex"] = [
+            int(idx) * 1e-27 for idx in reserves.liquidityIndex
+        ]
+        self.reserves["variableBorrowIndex"] = [
+            int(idx) * 1e-27 for idx in reserves.variableBorrowIndex
+        ]
+        self.reserves["reserveLiquidationThreshold"] = (
+            self.reserves.reserveLiquidationThreshold * 1e-4
+        )
+        self.reserves["Price"] = self.reserves.underlyingAsset.map(
+            last_prices.Price
+        ).astype(float)
+        self.assets = self.reserves.underlyingAsset.tolist()
+        self.C = _covariance_matrix(volatility, self.assets)
+        self.reserves.index = self.reserves.underlyingAsset.str.lower()
+
+        self.liquidation_params = liquidation_params.set_index(
+            liquidation_params.reserve.str.lower()
+        )
+
+        # Users state: scaled balances and collateral flags
+        self.positions = {}
+        self.holders = {}
+        for user, balances in users_balances.groupby(
+            users_balances.user_address.str.lower()
+        ):
+            position = balances[
+                [
+                    "underlyingAsset",
+                    "name",
+                    "decimals",
+                    "scaledATokenBalance",
+                    "scaledVariableDebt",
+                    "collateral_enabled",
+                ]
+            ].copy()
+            position[["scaledATokenBalance", "scaledVariableDebt"]] = position[
+                ["scaledATokenBalance", "scaledVariableDebt"]
+            ].astype(float)
+            position.index = position.underlyingAsset.str.lower()
+            self.positions[user] = position
+            for asset in position.index:
+                self.holders.setdefault(asset, set()).add(user)
+
+        # Latest trajectory point of each user
+        self.state = {}
+
+    def _call(self, call):
+        return _with_retries(call, retries=self.retries, wait=self.retry_wait)
+
+    def _is_known_reserve(self, asset: str, name: str) -> bool:
+        if asset in self.reserves.index:
+            return True
+        print(f"{name} on unknown reserve {asset} skipped")
+        return False
+
+    def _add_position(self, user: str, asset: str):
+        reserve = self.reserves.loc[asset]
+        self.positions[user].loc[asset] = pd.Series(
+            {
+                "underlyingAsset": reserve.underlyingAsset,
+                "name": reserve["name"],
+                "decimals": reserve.decimals,
+                "scaledATokenBalance": 0.0,
+                "scaledVariableDebt": 0.0,
+                "collateral_enabled": False,
+            }
+        )
+        self.holders.setdefault(asset, set()).add(user)
+
+    def _update_balance(self, user: str, asset: str, column: str, amount: float):
+        if asset not in self.positions[user].index:
+            self._add_position(user, asset)
+        if column == "scaledATokenBalance":
+            index = self.reserves.loc[asset, "liquidityIndex"]
+        else:
+            index = self.reserves.loc[asset, "variableBorrowIndex"]
+        self.positions[user].loc[asset, column] += amount / index
+
+    def _apply_log(self, log, touched: set):
+        event = self.decoders[bytes(log["topics"][0])].process_log(log)
+        name, args = event["event"], event["args"]
+
+        if name == "AnswerUpdated":
+            self.stale_prices.update(self.aggregators[log["address"].lower()])
+            return
+        if name == "ReserveDataUpdated":
+            asset = args["reserve"].lower()
+            if not self._is_known_reserve(asset, name):
+                return
+            self.reserves.loc[asset, "liquidityIndex"] = args["liquidityIndex"] * 1e-27
+            self.reserves.loc[asset, "variableBorrowIndex"] = (
+                args["variableBorrowIndex"] * 1e-27
+            )
+            return
+
+        if name in ["Supply", "Borrow"]:
+            user = args["onBehalfOf"].lower()
+        else:
+            user = args["user"].lower()
+        if user not in self.positions:
+            return
+
+        if name == "LiquidationCall":
+            assets = [args["collateralAsset"].lower(), args["debtAsset"].lower()]
+        else:
+            assets = [args["reserve"].lower()]
+        if not all(self._is_known_reserve(asset, name) for asset in assets):
+            return
+        touched.add(user)
+
+        if name == "Supply":
+            self._update_balance(
+                user, args["reserve"].lower(), "scaledATokenBalance", args["amount"]
+            )
+        elif name == "Borrow":
+            self._update_balance(
+                user, args["reserve"].lower(), "scaledVariableDebt", args["amount"]
+            )
+        elif name == "Withdraw":
+            self._update_balance(
+                user, args["reserve"].lower(), "scaledATokenBalance", -args["amount"]
+            )
+        elif name == "Repay":
+            asset = args["reserve"].lower()
+            self._update_balance(user, asset, "scaledVariableDebt", -args["amount"])
+            if args["useATokens"]:
+                self._update_balance(
+                    user, asset, "scaledATokenBalance", -args["amount"]
+                )
+        elif name == "LiquidationCall":
+            collateral_asset = args["collateralAsset"].lower()
+            params = self.liquidation_params.loc[collateral_asset]
+            withdraw_amount = _liquidation_withdraw_amount(
+                colAmount=args["liquidatedCollateralAmount"],
+                liquidationBonus=params.liquidationBonus,
+                liquidationProtocolFee=params.liquidationProtocolFee,
+            )
+            self._update_balance(
+                user, collateral_asset, "scaledATokenBalance", -withdraw_amount
+            )
+            self._update_balance(
+                user,
+                args["debtAsset"].lower(),
+                "scaledVariableDebt",
+                -args["debtToCover"],
+            )
+        elif name in [
+            "ReserveUsedAsCollateralEnabled",
+            "ReserveUsedAsCollateralDisabled",
+        ]:
+            asset = args["reserve"].lower()
+            if asset not in self.positions[user].index:
+                self._add_position(user, asset)
+            self.positions[user].loc[asset, "collateral_enabled"] = (
+                name == "ReserveUsedAsCollateralEnabled"
+            )
+
+    def _refresh_prices(self, block: int, touched: set):
+        """Re-read the stale prices from the Aave Oracle at `block`."""
+        assets = sorted(
+            asset
+            for asset in self.stale_prices
+            if self._is_known_reserve(asset, "AnswerUpdated")
+        )
+        self.stale_prices = set()
+        if not assets:
+            return
+        prices = self._call(
+            lambda: self.oracle.functions.getAssetsPrices(
+                [Web3.to_checksum_address(asset) for asset in assets]
+            ).call(block_identifier=block)
+        )
+        for asset, price in zip(assets, prices):
+            self.reserves.loc[asset, "Price"] = float(price)
+            touched.update(self.holders.get(asset, set()))
+
+    def _refresh_users(self, users: list, block: int, timestamp: int) -> DataFrame:
+        """Recompute balances, HF and probabilities of `users` in one pass."""
+        balances = pd.concat(
+            [self.positions[user].assign(user_address=user) for user in users]
+        )
+        balances["decimals"] = balances.decimals.astype(int)
+        balances["collateral_enabled"] = balances.collateral_enabled.astype(bool)
+        reserves = self.reserves.loc[balances.index]
+        balances["Price"] = reserves.Price.values
+        balances["reserveLiquidationThreshold"] = (
+            reserves.reserveLiquidationThreshold.values
+        )
+        balances["currentATokenBalance"] = (
+            balances.scaledATokenBalance * reserves.liquidityIndex.values
+        )
+        balances["currentVariableDebt"] = (
+            balances.scaledVariableDebt * reserves.variableBorrowIndex.values
+        )
+        balances = _add_usd_balances(balances.reset_index(drop=True))
+        balances["a"] = _compute_a(balances)
+        balances["BlockNumber"] = block
+        balances["Timestamp"] = timestamp
+
+        A = (
+            balances.pivot_table(
+                index="user_address",
+                columns="underlyingAsset",
+                values="a",
+                aggfunc="sum",
+                fill_value=0,
+            )
+            .reindex(index=users, columns=self.assets, fill_value=0)
+            .values.astype(float)
+        )
+        user_std, user_a, proba_p1 = _exposure_proba(A, self.C, self.detla_t)
+
+        hf = (
+            _health_factor(balances, keys=["user_address"])
+            .set_index("user_address")
+            .hf.reindex(users)
+        )
+        trajectory = DataFrame(
+            {
+                "BlockNumber": block,
+                "Timestamp": timestamp,
+                "user_std": user_std,
+                "user_a": user_a,
+                "proba_p1": proba_p1,
+                "proba_p2": np.minimum(1, 2 * proba_p1),
+                "hf": hf.values,
+                "user_address": users,
+            }
+        )
+
+        for record in trajectory.to_dict("records"):
+            self.state[record["user_address"]] = record
+        return trajectory
+
+    def current_state(self) -> DataFrame:
+        """The latest trajectory point of each user updated since the start."""
+        return DataFrame(list(self.state.values()))
+
+    def process_blocks(self, from_block: int, to_block: int) -> DataFrame:
+        """
+        Apply the logs of blocks [from_block, to_block] and return the new
+        trajectory points of the users touched in each block.
+        """
+        addresses = [self.pool_address] + [
+            Web3.to_checksum_address(address) for address in self.aggregators
+        ]
+        logs = self._call(
+            lambda: self.w3.eth.get_logs(
+                {
+                    "fromBlock": from_block,
+                    "toBlock": to_block,
+                    "address": addresses,
+                    "topics": [[Web3.to_hex(topic) for topic in self.decoders]],
+                }
+            )
+        )
+        logs = sorted(logs, key=lambda log: (log["blockNumber"], log["logIndex"]))
+
+        updates = []
+        touched = set()
+        for i, log in enumerate(logs):
+            self._apply_log(log, touched)
+            block = log["blockNumber"]
+            if i + 1 < len(logs) and logs[i + 1]["blockNumber"] == block:
+                continue
+            if self.stale_prices:
+                self._refresh_prices(block, touched)
+            if touched:
+                timestamp = self._call(lambda: self.w3.eth.get_block(block))[
+                    "timestamp"
+                ]
+                updates.append(self._refresh_users(sorted(touched), block, timestamp))
+                touched = set()
+
+        self.last_block = to_block
+        if not updates:
+            return DataFrame()
+        return pd.concat(updates, ignore_index=True)
+
+    def follow(
+        self,
+        poll_interval: float = 2,
+        max_blocks: int = 1000,
+        confirmations: int = 2,
+        callback=None,
+    ):
+        """
+        Follow the chain head forever, processing at most `max_blocks` blocks
+        per `get_logs` call, and pass each batch of updates to `callback`.
+        Only the blocks with `confirmations` blocks on top of them are
+        processed, since the logs of reorganised blocks cannot be undone.
+        """
+        while True:
+            head = self._call(lambda: self.w3.eth.block_number) - confirmations
+            if head <= self.last_block:
+                time.sleep(poll_interval)
+                continue
+            to_block = min(head, self.last_block + max_blocks)
+            updates = self.process_blocks(self.last_block + 1, to_block)
+            if callback is not None and not updates.empty:
+                callback(updates)
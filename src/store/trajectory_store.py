@@ -0,0 +1,236 @@
+import glob
+import os
+from datetime import datetime
+import pandas as pd
+from pandas import DataFrame
+
+
+TABLES = {
+    "trajectories": "liquidation_trajectories",
+    "balances": "users_balances",
+}
+
+
+def _sql_string(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _connect():
+    # duckdb is only needed when a store is used
+    import duckdb
+
+    return duckdb.connect()
+
+
+def _as_date(day):
+    return day.date() if isinstance(day, datetime) else day
+
+
+class TrajectoryStore:
+    """
+    Local Parquet store of the liquidation trajectories and users balances,
+    queried through DuckDB.
+
+    Each table is partitioned by snapshot_date (one file per day) and each
+    file is sorted by (user_address, BlockNumber) and written in small row
+    groups, so that the Parquet min/max statistics of user_address and
+    BlockNumber are tight. Filters are pushed down to DuckDB, which skips the
+    days outside the requested range and the row groups whose statistics
+    cannot match, e.g. a user lookup reads a single row group per day.
+
+    Args:
+        store_path (str): Local directory of the store
+        row_group_size (int): Number of rows per Parquet row group
+    """
+
+    def __init__(self, store_path: str, row_group_size: int = 8192):
+        self.store_path = store_path
+        self.row_group_size = row_group_size
+
+    def _day_path(self, table: str, day: datetime) -> str:
+        day_str = day.strftime("%Y-%m-%d")
+        return os.path.join(
+            self.store_path,
+            table,
+            f"snapshot_date={day_str}",
+            f"{TABLES[table]}.parquet",
+        )
+
+    def _write(self, table: str, day: datetime, data: DataFrame):
+        path = self._day_path(table=table, day=day)
+        if data.empty:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        data = data.copy()
+        data["user_address"] = data.user_address.str.lower()
+        if "underlyingAsset" in data.columns:
+            data["underlyingAsset"] = data.underlyingAsset.str.lower()
+        data["BlockNumber"] = data.BlockNumber.astype("int64")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + f".{os.getpid()}.tmp"
+        con = _connect()
+        try:
+            con.register("data", data)
+            con.execute(
+                f"""
+                COPY (SELECT * FROM data ORDER BY user_address, BlockNumber)
+                TO {_sql_string(tmp_path)}
+                (FORMAT PARQUET, ROW_GROUP_SIZE {int(self.row_group_size)})
+                """
+            )
+        finally:
+            con.close()
+        os.replace(tmp_path, path)
+
+    def ingest_day(
+        self, day: datetime, day_trajectories: DataFrame, day_user_balances: DataFrame
+    ):
+        """Write (or overwrite) the outputs of `day`."""
+        self._write(table="trajectories", day=day, data=day_trajectories)
+        self._write(table="balances", day=day, data=day_user_balances)
+
+    def ingest_s3_day(self, client_s3, output_path: str, day: datetime):
+        """Ingest the daily CSVs already uploaded to S3 by `main.py`."""
+        day_str = day.strftime("%Y-%m-%d")
+        outputs = {}
+        for table, name in TABLES.items():
+            try:
+                outputs[table] = pd.read_csv(
+                    client_s3.get_object(
+                        Bucket="projet-datalab-group-jprat",
+                        Key=output_path
+                        + f"liquidation_trajectories_snapshot_date={day_str}/{name}.csv",
+                    )["Body"]
+                )
+            except pd.errors.EmptyDataError:
+                outputs[table] = DataFrame()
+        self.ingest_day(
+            day=day,
+            day_trajectories=outputs["trajectories"],
+            day_user_balances=outputs["balances"],
+        )
+
+    def _query(
+        self,
+        table: str,
+        columns: list,
+        filters: list,
+        params: list,
+    ) -> DataFrame:
+        source = os.path.join(self.store_path, table, "*", "*.parquet")
+        if not glob.glob(source):
+            return DataFrame()
+        select = "*" if columns is None else ", ".join(f'"{col}"' for col in columns)
+        sql = (
+            f"SELECT {select} FROM read_parquet({_sql_string(source)}, "
+            "hive_partitioning = true, union_by_name = true)"
+        )
+        if filters:
+            sql += " WHERE " + " AND ".join(filters)
+        order_by = [
+            col
+            for col in ["user_address", "BlockNumber"]
+            if columns is None or col in columns
+        ]
+        if order_by:
+            sql += " ORDER BY " + ", ".join(order_by)
+        con = _connect()
+        try:
+            return con.execute(sql, params).df()
+        finally:
+            con.close()
+
+    @staticmethod
+    def _common_filters(
+        user: str,
+        start_day: datetime,
+        stop_day: datetime,
+        start_block: int,
+        stop_block: int,
+    ):
+        filters, params = [], []
+        if user is not None:
+            filters.append("user_address = ?")
+            params.append(user.lower())
+        if start_day is not None:
+            filters.append("snapshot_date >= ?")
+            params.append(_as_date(start_day))
+        if stop_day is not None:
+            filters.append("snapshot_date <= ?")
+            params.append(_as_date(stop_day))
+        if start_block is not None:
+            filters.append("BlockNumber >= ?")
+            params.append(int(start_block))
+        if stop_block is not None:
+            filters.append("BlockNumber <= ?")
+            params.append(int(stop_block))
+        return filters, params
+
+    def query_trajectories(
+        self,
+        user: str = None,
+        start_day: datetime = None,
+        stop_day: datetime = None,
+        start_block: int = None,
+        stop_block: int = None,
+        max_hf: float = None,
+        min_proba: float = None,
+        proba_column: str = "proba_p1",
+        columns: list = None,
+    ) -> DataFrame:
+        """
+        Trajectory points matching all the given filters, e.g.
+        `store.query_trajectories(user=X, start_day=datetime(2024, 3, 1),
+        stop_day=datetime(2024, 3, 31))` for the HF path of X over March.
+
+        Args:
+            user (str): User address
+            start_day, stop_day (datetime): Inclusive snapshot_date range
+            start_block, stop_block (int): Inclusive BlockNumber range
+            max_hf (float): Keep the points with hf <= max_hf
+            min_proba (float): Keep the points with proba_column >= min_proba
+            proba_column (str): Probability column filtered by `min_proba`,
+                proba_p1 is the base horizon of `main.py`, use e.g.
+                "proba_p1_7d" for its other horizons
+            columns (list): Columns to read, all by default
+
+        Returns:
+            (DataFrame): The matching points, sorted by user and block.
+        """
+        filters, params = self._common_filters(
+            user, start_day, stop_day, start_block, stop_block
+        )
+        if max_hf is not None:
+            filters.append("hf <= ?")
+            params.append(float(max_hf))
+        if min_proba is not None:
+            filters.append(f'"{proba_column}" >= ?')
+            params.append(float(min_proba))
+        return self._query(
+            table="trajectories", columns=columns, filters=filters, params=params
+        )
+
+    def query_balances(
+        self,
+        user: str = None,
+        start_day: datetime = None,
+        stop_day: datetime = None,
+        start_block: int = None,
+        stop_block: int = None,
+        asset: str = None,
+        columns: list = None,
+    ) -> DataFrame:
+        """
+        Users balances matching all the given filters, see
+        `query_trajectories()`. `asset` filters on underlyingAsset.
+        """
+        filters, params = self._common_filters(
+            user, start_day, stop_day, start_block, stop_block
+        )
+        if asset is not None:
+            filters.append("underlyingAsset = ?")
+            params.append(asset.lower())
+        return self._query(
+            table="balances", columns=columns, filters=filters, params=params
+        )
@@ -0,0 +1,105 @@
+import hashlib
+import inspect
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+
+CACHE_FORMAT_VERSION = "1"
+
+
+def _update_fingerprint(h, value):
+    if isinstance(value, (DataFrame, pd.Series)):
+        h.update(type(value).__name__.encode())
+        if isinstance(value, DataFrame):
+            h.update(repr((value.columns.tolist(), value.dtypes.tolist())).encode())
+        else:
+            h.update(repr((value.name, value.dtype)).encode())
+        try:
+            h.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+        except TypeError:
+            # Unhashable cells (lists, dicts) from json_normalize
+            h.update(value.to_json().encode())
+    elif isinstance(value, np.ndarray):
+        h.update(repr((value.shape, value.dtype.str)).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        for key in sorted(value):
+            h.update(repr(key).encode())
+            _update_fingerprint(h, value[key])
+    elif isinstance(value, (list, tuple)):
+        h.update(f"{type(value).__name__}{len(value)}".encode())
+        for item in value:
+            _update_fingerprint(h, item)
+    elif hasattr(value, "address"):
+        # Web3 contracts are identified by their address
+        h.update(f"contract:{value.address}".encode())
+    else:
+        h.update(repr(value).encode())
+
+
+def fingerprint(value) -> str:
+    """Stable hash of a (nested) stage input."""
+    h = hashlib.sha256()
+    _update_fingerprint(h, value)
+    return h.hexdigest()
+
+
+def code_version(func) -> str:
+    """Hash of the source file defining `func`."""
+    with open(inspect.getsourcefile(func), "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+class StageCache:
+    """
+    Memoize pipeline stages on disk under a hash of their inputs and of the
+    source file of the stage function, so that a rerun only recomputes the
+    stages whose inputs or code changed.
+
+    Args:
+        cache_path (str): Local directory where the stage outputs are pickled
+    """
+
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+        self.reused = {}
+        self.computed = {}
+
+    def run(self, stage: str, func, **kwargs):
+        """Return `func(**kwargs)`, loading it from the cache when available."""
+        key = fingerprint(
+            {
+                "format": CACHE_FORMAT_VERSION,
+                "function": func.__qualname__,
+                "code": code_version(func),
+                "inputs": kwargs,
+            }
+        )
+        path = os.path.join(self.cache_path, stage, f"{key}.pkl")
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                result = pickle.load(file)
+            self.reused[stage] = self.reused.get(stage, 0) + 1
+            return result
+
+        result = func(**kwargs)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + f".{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            pickle.dump(result, file)
+        os.replace(tmp_path, path)
+        self.computed[stage] = self.computed.get(stage, 0) + 1
+        return result
+
+    def report(self):
+        """Print and reset the reused / computed counts of each stage."""
+        for stage in sorted(set(self.reused) | set(self.computed)):
+            print(
+                f"      - Stage {stage}: reused {self.reused.get(stage, 0)}, "
+                f"computed {self.computed.get(stage, 0)}"
+            )
+        self.reused = {}
+        self.computed = {}
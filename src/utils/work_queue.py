@@ -0,0 +1,294 @@
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+
+class LeaseLostError(Exception):
+    """Raised by a worker whose unit was leased to another worker."""
+
+
+class WorkQueue:
+    """
+    SQLite work queue of (day, user-shard) units shared by several worker
+    nodes, e.g. through a shared filesystem.
+
+    Units are leased to one worker at a time for `lease_timeout` seconds: a
+    unit whose lease expired (crashed or stalled worker) is leased again,
+    up to `max_attempts` times. Workers write their partial outputs to
+    deterministic paths so that retries are idempotent. Once all the shards
+    of a day are done, the merge of the day is leased the same way, with
+    its own attempts and failed state.
+
+    Args:
+        db_path (str): Path of the SQLite database file
+        lease_timeout (float): Lease duration, in seconds
+        max_attempts (int): Number of leases after which a unit or a merge
+            is failed
+    """
+
+    def __init__(self, db_path: str, lease_timeout: float = 1800, max_attempts: int = 3):
+        self.db_path = db_path
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS units (
+                    day TEXT NOT NULL,
+                    shard INTEGER NOT NULL,
+                    n_shards INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, shard)
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS days (
+                    day TEXT PRIMARY KEY,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA busy_timeout = 60000")
+        return _Transaction(conn)
+
+    def enqueue(self, start: datetime, stop: datetime, n_shards: int):
+        """
+        Add the units of days [start, stop]; already queued units are kept.
+        Raises a ValueError if a day is already queued with another n_shards.
+        """
+        with self._connect() as conn:
+            day = start
+            while day <= stop:
+                day_str = day.strftime("%Y-%m-%d")
+                queued = conn.execute(
+                    "SELECT DISTINCT n_shards FROM units WHERE day = ?", (day_str,)
+                ).fetchall()
+                if queued and queued != [(n_shards,)]:
+                    raise ValueError(
+                        f"Day {day_str} is already queued with n_shards="
+                        f"{queued[0][0]}, not {n_shards}"
+                    )
+                conn.execute("INSERT OR IGNORE INTO days (day) VALUES (?)", (day_str,))
+                conn.executemany(
+                    "INSERT OR IGNORE INTO units (day, shard, n_shards) VALUES (?, ?, ?)",
+                    [(day_str, shard, n_shards) for shard in range(n_shards)],
+                )
+                day += timedelta(days=1)
+
+    def lease(self, worker: str):
+        """
+        Lease the next pending or expired unit to `worker`.
+
+        Returns:
+            (tuple): (day, shard, n_shards), or None if no unit is available.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                UPDATE units SET status = 'failed'
+                WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?
+                """,
+                (now, self.max_attempts),
+            )
+            row = conn.execute(
+                """
+                SELECT day, shard, n_shards FROM units
+                WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?)
+                ORDER BY day, shard
+                LIMIT 1
+                """,
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                """
+                UPDATE units
+                SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1
+                WHERE day = ? AND shard = ?
+                """,
+                (worker, now + self.lease_timeout, row[0], row[1]),
+            )
+        return datetime.strptime(row[0], "%Y-%m-%d"), row[1], row[2]
+
+    def heartbeat(self, worker: str, day: datetime, shard: int) -> bool:
+        """Extend the lease of a unit, returns False if the lease was lost."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                """
+                UPDATE units SET lease_expires = ?
+                WHERE day = ? AND shard = ? AND worker = ? AND status = 'leased'
+                """,
+                (
+                    time.time() + self.lease_timeout,
+                    day.strftime("%Y-%m-%d"),
+                    shard,
+                    worker,
+                ),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, worker: str, day: datetime, shard: int) -> bool:
+        """
+        Mark a unit leased by `worker` as done, returns False if the lease was
+        lost: the unit is then left to its new owner.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                """
+                UPDATE units SET status = 'done', lease_expires = NULL
+                WHERE day = ? AND shard = ? AND worker = ? AND status = 'leased'
+                """,
+                (day.strftime("%Y-%m-%d"), shard, worker),
+            )
+        return cursor.rowcount == 1
+
+    def release(self, worker: str, day: datetime, shard: int):
+        """Give a unit back after a failure so that it is retried."""
+        with self._connect() as conn:
+            conn.execute(
+                """
+                UPDATE units
+                SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                    lease_expires = NULL
+                WHERE day = ? AND shard = ? AND worker = ? AND status = 'leased'
+                """,
+                (self.max_attempts, day.strftime("%Y-%m-%d"), shard, worker),
+            )
+
+    def lease_merge(self, worker: str):
+        """
+        Lease the merge of a day whose shards are all done.
+
+        Returns:
+            (tuple): (day, n_shards), or None if no day is ready.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                UPDATE days SET status = 'failed'
+                WHERE status = 'merging' AND lease_expires < ? AND attempts >= ?
+                """,
+                (now, self.max_attempts),
+            )
+            row = conn.execute(
+                """
+                SELECT d.day, MAX(u.n_shards) FROM days d JOIN units u ON u.day = d.day
+                WHERE d.status = 'pending' OR (d.status = 'merging' AND d.lease_expires < ?)
+                GROUP BY d.day
+                HAVING SUM(u.status != 'done') = 0
+                ORDER BY d.day
+                LIMIT 1
+                """,
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                """
+                UPDATE days
+                SET status = 'merging', worker = ?, lease_expires = ?, attempts = attempts + 1
+                WHERE day = ?
+                """,
+                (worker, now + self.lease_timeout, row[0]),
+            )
+        return datetime.strptime(row[0], "%Y-%m-%d"), row[1]
+
+    def complete_merge(self, worker: str, day: datetime):
+        with self._connect() as conn:
+            conn.execute(
+                """
+                UPDATE days SET status = 'merged', lease_expires = NULL
+                WHERE day = ? AND worker = ? AND status = 'merging'
+                """,
+                (day.strftime("%Y-%m-%d"), worker),
+            )
+
+    def release_merge(self, worker: str, day: datetime):
+        """Give a merge back after a failure so that it is retried."""
+        with self._connect() as conn:
+            conn.execute(
+                """
+                UPDATE days
+                SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                    lease_expires = NULL
+                WHERE day = ? AND worker = ? AND status = 'merging'
+                """,
+                (self.max_attempts, day.strftime("%Y-%m-%d"), worker),
+            )
+
+    def requeue(self, start: datetime = None, stop: datetime = None) -> dict:
+        """
+        Give the failed units and merges of days [start, stop] (all days by
+        default) a new set of `max_attempts` attempts.
+
+        Returns:
+            (dict): The number of requeued units and days.
+        """
+        where, params = "status = 'failed'", []
+        if start is not None:
+            where += " AND day >= ?"
+            params.append(start.strftime("%Y-%m-%d"))
+        if stop is not None:
+            where += " AND day <= ?"
+            params.append(stop.strftime("%Y-%m-%d"))
+        requeued = {}
+        with self._connect() as conn:
+            for table in ["units", "days"]:
+                cursor = conn.execute(
+                    f"""
+                    UPDATE {table}
+                    SET status = 'pending', worker = NULL, lease_expires = NULL, attempts = 0
+                    WHERE {where}
+                    """,
+                    params,
+                )
+                requeued[table] = cursor.rowcount
+        return requeued
+
+    def status(self) -> dict:
+        """Number of units and of days per status."""
+        with self._connect() as conn:
+            units = conn.execute(
+                "SELECT status, COUNT(*) FROM units GROUP BY status"
+            ).fetchall()
+            days = conn.execute(
+                "SELECT status, COUNT(*) FROM days GROUP BY status"
+            ).fetchall()
+        return {"units": dict(units), "days": dict(days)}
+
+
+class _Transaction:
+    """Run the statements of a `with` block in one IMMEDIATE transaction."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.conn.execute("COMMIT")
+            else:
+                self.conn.execute("ROLLBACK")
+        finally:
+            self.conn.close()
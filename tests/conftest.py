@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.balances import _compute_a
+from src.prices_volatility.volatility_estimation import generate_prices_correlations
+
+
+@pytest.fixture
+def volatility():
+    # Stds on the diagonal, correlations elsewhere, as fitted in main.py
+    Sigma = np.array(
+        [
+            [0.6, 0.8, 0.3],
+            [0.8, 0.5, 0.2],
+            [0.3, 0.2, 0.9],
+        ]
+    )
+    return generate_prices_correlations(corr_matrix=Sigma, reserves_list=["X", "Y", "Z"])
+
+
+@pytest.fixture
+def user_balances():
+    # "W" has no volatility data
+    balances = pd.DataFrame(
+        {
+            "BlockNumber": [1, 1, 1, 1, 2, 2, 2, 3, 3],
+            "Timestamp": [10, 10, 10, 10, 20, 20, 20, 30, 30],
+            "underlyingAsset": ["X", "Y", "Z", "W", "X", "Y", "W", "X", "Z"],
+            "collateral_enabled": [True, False, True, True, True, True, False, True, False],
+            "currentATokenBalanceUSD": [1500.0, 0, 300, 200, 1400, 50, 0, 2000, 0],
+            "currentVariableDebtUSD": [0.0, 900, 250, 0, 0, 1000, 30, 0, 1500],
+            "reserveLiquidationThreshold": [0.8, 0.75, 0.7, 0.6, 0.8, 0.75, 0.6, 0.8, 0.7],
+        }
+    )
+    balances["name"] = balances.underlyingAsset
+    balances["a"] = _compute_a(balances)
+    return balances
@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.liquidation_proba.liquidation_estimation import (
+    compute_liquidation_proba,
+    compute_liquidation_proba_trajectory,
+    _horizon_label,
+)
+
+DETLA_T = 30 / 365
+HORIZONS = [1 / (365 * 24), DETLA_T, 90 / 365]
+
+
+def test_trajectory_matches_per_block_computation(user_balances, volatility):
+    # Block 1 and 2 hold "W", which has no volatility data
+    probas = compute_liquidation_proba_trajectory(
+        user_balances=user_balances, volatility=volatility, detla_t=DETLA_T
+    )
+    for block, block_balances in user_balances.groupby("BlockNumber"):
+        user_std, user_a, proba_p1 = compute_liquidation_proba(
+            block_balances, volatility, DETLA_T
+        )
+        row = probas[probas.BlockNumber == block].iloc[0]
+        assert row.user_std == pytest.approx(user_std)
+        assert row.user_a == pytest.approx(user_a)
+        assert row.proba_p1 == pytest.approx(proba_p1)
+        assert row.proba_p2 == pytest.approx(min(1, 2 * proba_p1))
+
+
+def test_wide_layout_keeps_base_horizon_columns(user_balances, volatility):
+    base = compute_liquidation_proba_trajectory(
+        user_balances=user_balances, volatility=volatility, detla_t=DETLA_T
+    )
+    wide = compute_liquidation_proba_trajectory(
+        user_balances=user_balances,
+        volatility=volatility,
+        detla_t=DETLA_T,
+        horizons=HORIZONS,
+    )
+    pd.testing.assert_frame_equal(wide[base.columns], base)
+    assert wide.columns[len(base.columns):].tolist() == [
+        "user_std_1h",
+        "proba_p1_1h",
+        "proba_p2_1h",
+        "user_std_90d",
+        "proba_p1_90d",
+        "proba_p2_90d",
+    ]
+
+
+def test_wide_and_long_layouts_are_equivalent(user_balances, volatility):
+    wide = compute_liquidation_proba_trajectory(
+        user_balances=user_balances,
+        volatility=volatility,
+        detla_t=DETLA_T,
+        horizons=HORIZONS,
+    )
+    long = compute_liquidation_proba_trajectory(
+        user_balances=user_balances,
+        volatility=volatility,
+        detla_t=DETLA_T,
+        horizons=HORIZONS,
+        layout="long",
+    )
+    assert len(long) == len(wide) * len(HORIZONS)
+    for horizon, label in zip(HORIZONS, ["1h", "30d", "90d"]):
+        rows = long[long.horizon == label].reset_index(drop=True)
+        assert np.allclose(rows.horizon_years, horizon)
+        suffix = "" if horizon == DETLA_T else f"_{label}"
+        for column in ["user_std", "proba_p1", "proba_p2"]:
+            assert np.allclose(rows[column], wide[column + suffix])
+        assert np.allclose(rows.user_a, wide.user_a)
+
+
+def test_horizons_must_contain_base_horizon(user_balances, volatility):
+    with pytest.raises(ValueError):
+        compute_liquidation_proba_trajectory(
+            user_balances=user_balances,
+            volatility=volatility,
+            detla_t=1 / 365,
+            horizons=HORIZONS,
+        )
+
+
+def test_horizon_labels():
+    assert _horizon_label(7 / 365) == "7d"
+    assert _horizon_label(1 / (365 * 24)) == "1h"
+    assert _horizon_label(30 / (365 * 24 * 60)) == "30m"
+    with pytest.raises(ValueError):
+        _horizon_label(1 / (365 * 24 * 60 * 2))
+
+
+def test_horizons_without_label_are_rejected(user_balances, volatility):
+    with pytest.raises(ValueError):
+        compute_liquidation_proba_trajectory(
+            user_balances=user_balances,
+            volatility=volatility,
+            detla_t=DETLA_T,
+            horizons=[DETLA_T, 1.5 / (365 * 24 * 60)],
+        )
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from src.data.balances import _compute_a
+from src.liquidation_proba.liquidation_estimation import (
+    compute_liquidation_proba_trajectory,
+    compute_liquidation_sensitivities,
+)
+
+DETLA_T = 30 / 365
+
+
+def _proba(user_balances, volatility, block):
+    probas = compute_liquidation_proba_trajectory(
+        user_balances=user_balances, volatility=volatility, detla_t=DETLA_T
+    )
+    return probas.loc[probas.BlockNumber == block, "proba_p1"].item()
+
+
+def _finite_difference(user_balances, volatility, row, bump):
+    """Central difference of proba_p1 for a relative `bump` of the row."""
+    up, down = user_balances.copy(), user_balances.copy()
+    bump(up, row, 1)
+    bump(down, row, -1)
+    up["a"] = _compute_a(up)
+    down["a"] = _compute_a(down)
+    block = user_balances.loc[row, "BlockNumber"]
+    return _proba(up, volatility, block) - _proba(down, volatility, block)
+
+
+EPS = 1e-5
+
+
+def _bump_column(column):
+    def bump(balances, row, sign):
+        balances.loc[row, column] += sign * EPS
+    return bump
+
+
+def _bump_log_price(balances, row, sign):
+    for column in ["currentATokenBalanceUSD", "currentVariableDebtUSD"]:
+        balances.loc[row, column] *= np.exp(sign * EPS)
+
+
+@pytest.mark.parametrize(
+    "gradient, bump",
+    [
+        ("dproba_dcollateral", _bump_column("currentATokenBalanceUSD")),
+        ("dproba_ddebt", _bump_column("currentVariableDebtUSD")),
+        ("dproba_dlt", _bump_column("reserveLiquidationThreshold")),
+        ("dproba_dlogprice", _bump_log_price),
+    ],
+)
+def test_sensitivities_match_finite_differences(
+    user_balances, volatility, gradient, bump
+):
+    sensitivities = compute_liquidation_sensitivities(
+        user_balances=user_balances, volatility=volatility, detla_t=DETLA_T
+    )
+    for row in user_balances.index:
+        expected = _finite_difference(user_balances, volatility, row, bump) / (
+            2 * EPS
+        )
+        assert sensitivities.loc[row, gradient] == pytest.approx(
+            expected, rel=1e-4, abs=1e-9
+        )
+
+
+def test_sensitivities_layout(user_balances, volatility):
+    sensitivities = compute_liquidation_sensitivities(
+        user_balances=user_balances, volatility=volatility, detla_t=DETLA_T
+    )
+    assert len(sensitivities) == len(user_balances)
+    assert (
+        sensitivities[["BlockNumber", "Timestamp", "underlyingAsset"]].values.tolist()
+        == user_balances[["BlockNumber", "Timestamp", "underlyingAsset"]].values.tolist()
+    )
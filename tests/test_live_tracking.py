@@ -0,0 +1,460 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+from eth_abi import encode
+from hexbytes import HexBytes
+from pandas import DataFrame
+from requests.exceptions import ConnectionError
+from web3 import Web3
+from web3.datastructures import AttributeDict
+
+from src.data.balances import (
+    add_liquidation_to_user_events,
+    compute_user_balances,
+    process_user_balances,
+)
+from src.live import live_tracking
+from src.live.live_tracking import LiveTrajectoryTracker
+from src.liquidation_proba.liquidation_estimation import (
+    compute_health_factor_trajectory,
+    compute_liquidation_proba_trajectory,
+)
+from src.prices_volatility.volatility_estimation import generate_prices_correlations
+
+DETLA_T = 30 / 365
+X, Y, Z, W = ["0x" + digit * 40 for digit in "abcd"]
+U1, U2, U3 = ["0x" + digit * 40 for digit in "123"]
+POOL = "0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2"
+AGGREGATOR = "0x" + "9" * 40
+# Reserve indexes (ray) and LT (bps) at the snapshot, X is also updated in
+# block 101
+INDEXES = {X: (1.02, 1.05), Y: (1.01, 1.03), Z: (1.0, 1.1)}
+LT = {X: 8000, Y: 7500, Z: 7000}
+IDS = {X: 0, Y: 1, Z: 2}
+PRICES = {X: 2000e8, Y: 1e8, Z: 30000e8}
+
+with open("src/abi/pool.abi") as file:
+    POOL_ABI = json.load(file)
+with open("src/abi/aggregator.abi") as file:
+    AGGREGATOR_ABI = json.load(file)
+
+
+def _event_abi(abi: list, name: str) -> dict:
+    return next(e for e in abi if e["type"] == "event" and e["name"] == name)
+
+
+def _log(name: str, block: int, log_index: int, address: str = POOL, **args):
+    """An encoded log, as returned by `eth_getLogs`."""
+    abi = _event_abi(AGGREGATOR_ABI if name == "AnswerUpdated" else POOL_ABI, name)
+    signature = "{}({})".format(name, ",".join(arg["type"] for arg in abi["inputs"]))
+    indexed = [arg for arg in abi["inputs"] if arg["indexed"]]
+    data = [arg for arg in abi["inputs"] if not arg["indexed"]]
+    return AttributeDict(
+        {
+            "address": Web3.to_checksum_address(address),
+            "topics": [HexBytes(Web3.keccak(text=signature))]
+            + [HexBytes(encode([arg["type"]], [args[arg["name"]]])) for arg in indexed],
+            "data": HexBytes(
+                encode([arg["type"] for arg in data], [args[arg["name"]] for arg in data])
+            ),
+            "blockNumber": block,
+            "logIndex": log_index,
+            "transactionIndex": 0,
+            "transactionHash": HexBytes(b"\x00" * 32),
+            "blockHash": HexBytes(block.to_bytes(32, "big")),
+            "removed": False,
+        }
+    )
+
+
+def _supply(block, log_index, reserve, user, amount):
+    return _log(
+        "Supply", block, log_index, reserve=reserve, user=user, onBehalfOf=user,
+        amount=amount, referralCode=0,
+    )
+
+
+def _borrow(block, log_index, reserve, user, amount):
+    return _log(
+        "Borrow", block, log_index, reserve=reserve, user=user, onBehalfOf=user,
+        amount=amount, interestRateMode=2, borrowRate=0, referralCode=0,
+    )
+
+
+def _withdraw(block, log_index, reserve, user, amount):
+    return _log(
+        "Withdraw", block, log_index, reserve=reserve, user=user, to=user, amount=amount
+    )
+
+
+def _repay(block, log_index, reserve, user, amount, use_atokens):
+    return _log(
+        "Repay", block, log_index, reserve=reserve, user=user, repayer=user,
+        amount=amount, useATokens=use_atokens,
+    )
+
+
+def _liquidation(block, log_index, collateral, debt, user, debt_to_cover, collateral_amount):
+    return _log(
+        "LiquidationCall", block, log_index, collateralAsset=collateral,
+        debtAsset=debt, user=user, debtToCover=debt_to_cover,
+        liquidatedCollateralAmount=collateral_amount, liquidator=U3,
+        receiveAToken=False,
+    )
+
+
+def _collateral(block, log_index, reserve, user, enabled):
+    name = "ReserveUsedAsCollateral" + ("Enabled" if enabled else "Disabled")
+    return _log(name, block, log_index, reserve=reserve, user=user)
+
+
+def _reserve_data_updated(block, log_index, reserve, liquidity_index, borrow_index):
+    return _log(
+        "ReserveDataUpdated", block, log_index, reserve=reserve, liquidityRate=0,
+        stableBorrowRate=0, variableBorrowRate=0, liquidityIndex=liquidity_index,
+        variableBorrowIndex=borrow_index,
+    )
+
+
+def _answer_updated(block, log_index):
+    return _log(
+        "AnswerUpdated", block, log_index, address=AGGREGATOR, current=1,
+        roundId=1, updatedAt=0,
+    )
+
+
+class _Call:
+    def __init__(self, result):
+        self.result = result
+
+    def call(self, block_identifier=None):
+        return self.result(block_identifier)
+
+
+class _Functions:
+    def __init__(self, **functions):
+        self.__dict__.update(functions)
+
+
+class FakeOracle:
+    """Aave Oracle whose prices change at given blocks."""
+
+    def __init__(self, price_updates: dict):
+        self.price_updates = price_updates
+        self.calls = []
+        self.functions = _Functions(getAssetsPrices=self._get_assets_prices)
+
+    def price(self, asset: str, block: int) -> float:
+        updates = [b for b in self.price_updates.get(asset, {}) if b <= block]
+        return self.price_updates[asset][max(updates)] if updates else PRICES[asset]
+
+    def _get_assets_prices(self, assets):
+        self.calls.append(assets)
+        return _Call(lambda block: [int(self.price(a.lower(), block)) for a in assets])
+
+
+class FakePool:
+    """Aave Pool returning the user configuration of given collateral flags."""
+
+    def __init__(self, flags):
+        self.flags = flags
+        self.functions = _Functions(getUserConfiguration=self._get_user_configuration)
+
+    def _get_user_configuration(self, user):
+        def configuration(block):
+            return [
+                sum(
+                    1 << (2 * IDS[asset] + 1)
+                    for asset, enabled in self.flags(user, block).items()
+                    if enabled
+                )
+            ]
+
+        return _Call(configuration)
+
+
+@pytest.fixture
+def reserves():
+    return DataFrame(
+        {
+            "underlyingAsset": [X, Y, Z],
+            "name": ["X", "Y", "Z"],
+            "decimals": 18,
+            "reserveLiquidationThreshold": [LT[a] for a in [X, Y, Z]],
+            "liquidityIndex": [str(int(INDEXES[a][0] * 10**27)) for a in [X, Y, Z]],
+            "variableBorrowIndex": [str(int(INDEXES[a][1] * 10**27)) for a in [X, Y, Z]],
+        }
+    )
+
+
+@pytest.fixture
+def liquidation_params():
+    return DataFrame(
+        {
+            "reserve": [X, Y, Z],
+            "id": [IDS[a] for a in [X, Y, Z]],
+            "liquidationBonus": [10500, 10400, 10750],
+            "liquidationProtocolFee": [1000, 1000, 2000],
+        }
+    )
+
+
+@pytest.fixture
+def live_volatility():
+    Sigma = np.array([[0.6, 0.8, 0.3], [0.8, 0.05, 0.2], [0.3, 0.2, 0.9]])
+    return generate_prices_correlations(corr_matrix=Sigma, reserves_list=[X, Y, Z])
+
+
+@pytest.fixture
+def users_balances():
+    # U1 holds all the assets it uses during the day, so that the batch
+    # computation (which only follows the snapshot assets) covers them
+    return DataFrame(
+        {
+            "user_address": [U1, U1, U1, U2, U2],
+            "underlyingAsset": [X, Y, Z, Z, Y],
+            "name": ["X", "Y", "Z", "Z", "Y"],
+            "decimals": 18,
+            "scaledATokenBalance": [10e18, 1000e18, 0.0, 1e18, 0.0],
+            "scaledVariableDebt": [0.0, 15000e18, 0.0, 0.0, 1000e18],
+            "collateral_enabled": [True, False, False, True, False],
+        }
+    )
+
+
+@pytest.fixture
+def make_tracker(reserves, liquidation_params, live_volatility, users_balances):
+    def make_tracker(logs, oracle=None, **kwargs):
+        w3 = Web3()
+        w3.eth.get_logs = lambda params: [
+            log
+            for log in logs
+            if params["fromBlock"] <= log["blockNumber"] <= params["toBlock"]
+        ]
+        w3.eth.get_block = lambda block: {"timestamp": 1000 + block}
+        return LiveTrajectoryTracker(
+            w3=w3,
+            pool=w3.eth.contract(address=POOL, abi=POOL_ABI),
+            users_balances=users_balances,
+            reserves=reserves,
+            prices=DataFrame(
+                {
+                    "UnderlyingToken": list(PRICES),
+                    "Timestamp": 0,
+                    "Price": list(PRICES.values()),
+                }
+            ),
+            liquidation_params=liquidation_params,
+            volatility=live_volatility,
+            detla_t=DETLA_T,
+            start_block=101,
+            oracle=oracle or FakeOracle({}),
+            aggregators={AGGREGATOR: [X]},
+            aggregator_abi=AGGREGATOR_ABI,
+            retry_wait=0,
+            **kwargs,
+        )
+
+    return make_tracker
+
+
+# Events of U1, and of the untracked U3
+LOGS = [
+    _reserve_data_updated(101, 0, X, int(1.03 * 10**27), int(1.06 * 10**27)),
+    _supply(101, 1, X, U1, int(2e18)),
+    _supply(101, 2, X, U3, int(5e18)),
+    _borrow(102, 0, Y, U1, int(1000e18)),
+    _collateral(102, 1, Z, U1, True),
+    _supply(102, 2, Z, U1, int(0.05e18)),
+    _withdraw(103, 0, X, U1, int(1e18)),
+    _repay(103, 1, Y, U1, int(500e18), False),
+    _repay(104, 0, Y, U1, int(200e18), True),
+    _answer_updated(105, 0),
+    _liquidation(106, 0, X, Y, U1, int(300e18), int(0.2e18)),
+    _collateral(106, 1, Z, U1, False),
+]
+# The batch events of the same day: the data API has no useATokens flag, the
+# aTokens burnt by the repay of block 104 are a withdraw
+EVENTS = [
+    (101, X, "supply", 2e18),
+    (102, Y, "borrow", 1000e18),
+    (102, Z, "supply", 0.05e18),
+    (103, X, "withdraw", 1e18),
+    (103, Y, "repay", 500e18),
+    (104, Y, "repay", 200e18),
+    (104, Y, "withdraw", 200e18),
+]
+BLOCKS = range(101, 107)
+
+
+def _u1_flags(user, block):
+    return {X: True, Y: False, Z: 102 <= block < 106}
+
+
+def _batch_trajectory(reserves, liquidation_params, live_volatility, users_balances, oracle):
+    """U1 trajectory computed by `main.py`, with the flags read at each block."""
+    day_prices = DataFrame(
+        [
+            {
+                "UnderlyingToken": asset,
+                "BlockNumber": block,
+                "Price": oracle.price(asset, block),
+                "Timestamp": 1000 + block,
+            }
+            for block in BLOCKS
+            for asset in [X, Y, Z]
+        ]
+    )
+    user_events = DataFrame(EVENTS, columns=["blockNumber", "reserve", "action", "amount"])
+    add_liquidation_to_user_events(
+        user_events,
+        DataFrame(
+            {
+                "blockNumber": [106],
+                "collateralAsset": [X],
+                "debtAsset": [Y],
+                "debtToCover": [300e18],
+                "liquidatedCollateralAmount": [0.2e18],
+            }
+        ),
+        liquidation_params,
+    )
+    reserves_data_updated = DataFrame(
+        {
+            "reserve": [X],
+            "blockNumber": [101],
+            "liquidityIndex": [str(int(1.03 * 10**27))],
+            "variableBorrowIndex": [str(int(1.06 * 10**27))],
+        }
+    )
+    balances = compute_user_balances(
+        user_initial_balance=users_balances[users_balances.user_address == U1].drop(
+            columns="collateral_enabled"
+        ),
+        day_prices=day_prices,
+        user_events=user_events,
+        reserves_data_updated=reserves_data_updated,
+        reserves=reserves,
+    )
+    trajectories = []
+    for block in BLOCKS:
+        processed = process_user_balances(
+            user=U1,
+            user_balances=balances[balances.BlockNumber == block],
+            reserves=reserves,
+            pool=FakePool(_u1_flags),
+            liquidation_params=liquidation_params,
+        )
+        trajectories.append(
+            compute_liquidation_proba_trajectory(
+                user_balances=processed, volatility=live_volatility, detla_t=DETLA_T
+            ).merge(
+                compute_health_factor_trajectory(user_balances=processed),
+                on=["BlockNumber", "Timestamp"],
+            )
+        )
+    return pd.concat(trajectories, ignore_index=True)
+
+
+def test_tracker_matches_batch_computation(
+    make_tracker, reserves, liquidation_params, live_volatility, users_balances
+):
+    oracle = FakeOracle({X: {105: 2100e8}})
+    tracker = make_tracker(LOGS, oracle=oracle)
+    updates = tracker.process_blocks(101, 106)
+
+    expected = _batch_trajectory(
+        reserves, liquidation_params, live_volatility, users_balances, oracle
+    )
+    assert updates.BlockNumber.tolist() == list(BLOCKS)
+    assert (updates.user_address == U1).all()
+    for column in ["Timestamp", "user_std", "user_a", "proba_p1", "proba_p2", "hf"]:
+        assert np.allclose(updates[column], expected[column]), column
+    # The collateral flags changed the HF
+    assert not np.isclose(updates.hf[1], updates.hf[0])
+    # The AnswerUpdated event re-read the price of X at its block
+    assert oracle.calls == [[Web3.to_checksum_address(X)]]
+    assert tracker.reserves.loc[X, "Price"] == 2100e8
+    assert tracker.last_block == 106
+
+
+def test_untouched_users_are_not_recomputed(make_tracker, monkeypatch):
+    tracker = make_tracker(LOGS + [_supply(107, 0, Y, U2, int(10e18))])
+    refreshed = []
+    refresh_users = tracker._refresh_users
+
+    def spy(users, block, timestamp):
+        refreshed.append((block, users))
+        return refresh_users(users, block, timestamp)
+
+    monkeypatch.setattr(tracker, "_refresh_users", spy)
+    tracker.process_blocks(101, 106)
+    # Neither the index update of block 101 nor the price of X (not held by
+    # U2) touch U2, and the events of U3 are ignored
+    assert refreshed == [(block, [U1]) for block in BLOCKS]
+    assert set(tracker.state) == {U1}
+
+    updates = tracker.process_blocks(107, 107)
+    assert updates.user_address.tolist() == [U2]
+    assert set(tracker.current_state().user_address) == {U1, U2}
+
+
+def test_unknown_reserves_are_skipped(make_tracker):
+    tracker = make_tracker(
+        [
+            _reserve_data_updated(101, 0, W, 10**27, 10**27),
+            _supply(101, 1, W, U1, int(1e18)),
+            _liquidation(102, 0, W, Y, U1, int(300e18), int(0.2e18)),
+            _collateral(102, 1, W, U1, True),
+            _borrow(103, 0, Y, U1, int(1000e18)),
+        ]
+    )
+    reserves = tracker.reserves.copy()
+    position = tracker.positions[U1].copy()
+
+    updates = tracker.process_blocks(101, 103)
+    assert updates.BlockNumber.tolist() == [103]
+    assert W not in tracker.reserves.index
+    assert W not in tracker.positions[U1].index
+    pd.testing.assert_frame_equal(tracker.reserves, reserves)
+    assert np.isclose(
+        tracker.positions[U1].loc[Y, "scaledVariableDebt"],
+        position.loc[Y, "scaledVariableDebt"] + 1000e18 / INDEXES[Y][1],
+    )
+
+
+def test_node_calls_are_retried(make_tracker):
+    tracker = make_tracker(LOGS)
+    get_logs = tracker.w3.eth.get_logs
+    failures = []
+
+    def flaky_get_logs(params):
+        if len(failures) < 2:
+            failures.append(params)
+            raise ConnectionError("Connection reset")
+        return get_logs(params)
+
+    tracker.w3.eth.get_logs = flaky_get_logs
+    assert not tracker.process_blocks(101, 106).empty
+
+    failures.clear()
+    tracker.retries = 2
+    with pytest.raises(ConnectionError):
+        tracker.process_blocks(107, 107)
+
+
+def test_follow_waits_for_confirmations(make_tracker, monkeypatch):
+    tracker = make_tracker(LOGS)
+    tracker.w3.eth.get_block_number = lambda: 106
+    processed = []
+
+    def stop(poll_interval):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(live_tracking.time, "sleep", stop)
+    with pytest.raises(KeyboardInterrupt):
+        tracker.follow(confirmations=2, callback=processed.append)
+    assert tracker.last_block == 104
+    assert pd.concat(processed).BlockNumber.max() == 104
@@ -0,0 +1,75 @@
+import importlib.util
+
+import numpy as np
+import pandas as pd
+
+from src.utils.stage_cache import StageCache, fingerprint
+
+
+def _load_stage_module(path, factor):
+    path.write_text(f"def stage(prices, factor):\n    return prices * factor * {factor}\n")
+    spec = importlib.util.spec_from_file_location("cached_stage_module", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_stage_is_reused_only_for_identical_inputs(tmp_path):
+    calls = []
+
+    def stage(prices, factor):
+        calls.append(factor)
+        return prices * factor
+
+    cache = StageCache(cache_path=str(tmp_path / "cache"))
+    prices = pd.DataFrame({"Price": [1.0, 2.0]})
+
+    first = cache.run("stage", stage, prices=prices, factor=2)
+    second = cache.run("stage", stage, prices=prices.copy(), factor=2)
+    cache.run("stage", stage, prices=prices, factor=3)
+
+    pd.testing.assert_frame_equal(first, second)
+    assert calls == [2, 3]
+    assert cache.reused == {"stage": 1}
+    assert cache.computed == {"stage": 2}
+
+    # The cache persists across runs
+    rerun = StageCache(cache_path=str(tmp_path / "cache"))
+    rerun.run("stage", stage, prices=prices, factor=3)
+    assert calls == [2, 3]
+    assert rerun.reused == {"stage": 1}
+
+
+def test_code_change_invalidates_stage(tmp_path):
+    cache = StageCache(cache_path=str(tmp_path / "cache"))
+    prices = pd.DataFrame({"Price": [1.0, 2.0]})
+
+    module = _load_stage_module(tmp_path / "stage_v1.py", factor=1)
+    cache.run("stage", module.stage, prices=prices, factor=2)
+    module = _load_stage_module(tmp_path / "stage_v1.py", factor=10)
+    result = cache.run("stage", module.stage, prices=prices, factor=2)
+
+    assert result.Price.tolist() == [20.0, 40.0]
+    assert cache.computed == {"stage": 2}
+
+
+def test_report_resets_counts(tmp_path, capsys):
+    def stage(a):
+        return a.sum()
+
+    cache = StageCache(cache_path=str(tmp_path / "cache"))
+    cache.run("stage", stage, a=np.arange(3))
+    cache.run("stage", stage, a=np.arange(3))
+    cache.report()
+
+    assert "Stage stage: reused 1, computed 1" in capsys.readouterr().out
+    assert cache.reused == {} and cache.computed == {}
+
+
+def test_fingerprint_depends_on_values_and_columns():
+    balances = pd.DataFrame({"a": [1.0, 2.0], "b": ["x", "y"]})
+
+    assert fingerprint(balances) == fingerprint(balances.copy())
+    assert fingerprint(balances) != fingerprint(balances.assign(a=[1.0, 3.0]))
+    assert fingerprint(balances) != fingerprint(balances.rename(columns={"b": "c"}))
+    assert fingerprint(np.arange(3)) != fingerprint(np.arange(3).reshape(3, 1))
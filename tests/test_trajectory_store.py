@@ -0,0 +1,136 @@
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas import DataFrame
+
+pytest.importorskip("duckdb")
+
+from src.store.trajectory_store import TrajectoryStore
+
+DAY_1 = datetime(2024, 4, 5)
+DAY_2 = datetime(2024, 4, 6)
+
+
+def _trajectories(users, blocks, hf, proba, extra_horizon=None):
+    trajectories = DataFrame(
+        {
+            "BlockNumber": blocks,
+            "Timestamp": [1000 + block for block in blocks],
+            "user_std": 1.0,
+            "user_a": -1.0,
+            "proba_p1": proba,
+            "proba_p2": np.minimum(1, 2 * np.array(proba)),
+            "hf": hf,
+            "user_address": users,
+        }
+    )
+    if extra_horizon is not None:
+        trajectories[f"proba_p1_{extra_horizon}"] = proba
+    return trajectories
+
+
+def _balances(users, blocks, assets):
+    return DataFrame(
+        {
+            "BlockNumber": blocks,
+            "underlyingAsset": assets,
+            "currentATokenBalanceUSD": 100.0,
+            "user_address": users,
+        }
+    )
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = TrajectoryStore(store_path=str(tmp_path), row_group_size=2)
+    store.ingest_day(
+        day=DAY_1,
+        day_trajectories=_trajectories(
+            users=["0xAA", "0xAA", "0xBB"],
+            blocks=[1, 2, 1],
+            hf=[1.5, 1.1, 3.0],
+            proba=[0.01, 0.2, 0.001],
+        ),
+        day_user_balances=_balances(
+            users=["0xAA", "0xAA", "0xBB"], blocks=[1, 2, 1], assets=["0xCC"] * 3
+        ),
+    )
+    store.ingest_day(
+        day=DAY_2,
+        day_trajectories=_trajectories(
+            users=["0xAA", "0xBB"],
+            blocks=[10, 10],
+            hf=[0.9, 2.0],
+            proba=[0.6, 0.05],
+            extra_horizon="7d",
+        ),
+        day_user_balances=_balances(
+            users=["0xAA", "0xBB"], blocks=[10, 10], assets=["0xCC", "0xDD"]
+        ),
+    )
+    return store
+
+
+def test_ingest_and_overwrite_day(store):
+    assert len(store.query_trajectories()) == 5
+    store.ingest_day(
+        day=DAY_1,
+        day_trajectories=_trajectories(
+            users=["0xAA"], blocks=[3], hf=[1.2], proba=[0.1]
+        ),
+        day_user_balances=_balances(users=["0xAA"], blocks=[3], assets=["0xCC"]),
+    )
+    trajectories = store.query_trajectories(start_day=DAY_1, stop_day=DAY_1)
+    assert trajectories.BlockNumber.tolist() == [3]
+    assert trajectories.user_address.tolist() == ["0xaa"]
+    assert len(store.query_trajectories()) == 3
+
+
+def test_empty_day_removes_file(store):
+    path = store._day_path(table="trajectories", day=DAY_1)
+    assert os.path.exists(path)
+    store.ingest_day(
+        day=DAY_1, day_trajectories=DataFrame(), day_user_balances=DataFrame()
+    )
+    assert not os.path.exists(path)
+    assert not os.path.exists(store._day_path(table="balances", day=DAY_1))
+    assert store.query_trajectories().BlockNumber.tolist() == [10, 10]
+
+
+def test_query_filters(store):
+    user = store.query_trajectories(user="0xaa")
+    assert user.user_address.unique().tolist() == ["0xaa"]
+    assert user.BlockNumber.tolist() == [1, 2, 10]
+
+    day = store.query_trajectories(start_day=DAY_2)
+    assert day.BlockNumber.tolist() == [10, 10]
+
+    blocks = store.query_trajectories(start_block=2, stop_block=10)
+    assert blocks.BlockNumber.tolist() == [2, 10, 10]
+
+    at_risk = store.query_trajectories(max_hf=1.1)
+    assert sorted(at_risk.hf.tolist()) == [0.9, 1.1]
+
+    likely = store.query_trajectories(min_proba=0.2, columns=["user_address", "proba_p1"])
+    assert likely.columns.tolist() == ["user_address", "proba_p1"]
+    assert sorted(likely.proba_p1.tolist()) == [0.2, 0.6]
+
+
+def test_query_balances_asset_is_case_insensitive(store):
+    balances = store.query_balances(asset="0xcc")
+    assert len(balances) == 4
+    assert balances.underlyingAsset.unique().tolist() == ["0xcc"]
+    assert len(store.query_balances(asset="0xDD")) == 1
+
+
+def test_days_with_different_horizons_are_unioned(store):
+    trajectories = store.query_trajectories()
+    assert "proba_p1_7d" in trajectories.columns
+    day_1 = trajectories[trajectories.BlockNumber < 10]
+    assert day_1.proba_p1_7d.isna().all()
+    likely = store.query_trajectories(min_proba=0.5, proba_column="proba_p1_7d")
+    assert likely.BlockNumber.tolist() == [10]
+    assert pd.api.types.is_float_dtype(likely.proba_p1_7d)
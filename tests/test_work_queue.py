@@ -0,0 +1,117 @@
+from datetime import datetime
+
+import pytest
+
+from src.utils import work_queue
+from src.utils.work_queue import WorkQueue
+
+DAY = datetime(2024, 4, 5)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(work_queue.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def queue(tmp_path, clock):
+    queue = WorkQueue(db_path=str(tmp_path / "queue.db"), lease_timeout=10, max_attempts=2)
+    queue.enqueue(start=DAY, stop=DAY, n_shards=2)
+    return queue
+
+
+def test_enqueue_is_idempotent_and_rejects_other_n_shards(queue):
+    queue.enqueue(start=DAY, stop=DAY, n_shards=2)
+    assert queue.status()["units"] == {"pending": 2}
+
+    with pytest.raises(ValueError):
+        queue.enqueue(start=DAY, stop=DAY, n_shards=4)
+
+
+def test_units_are_leased_once_until_expiry(queue, clock):
+    assert queue.lease("a") == (DAY, 0, 2)
+    assert queue.lease("b") == (DAY, 1, 2)
+    assert queue.lease("c") is None
+
+    clock[0] += 5
+    assert queue.heartbeat("a", DAY, 0)
+    clock[0] += 6
+    # Shard 1 expired, shard 0 was extended by the heartbeat
+    assert queue.lease("c") == (DAY, 1, 2)
+    assert not queue.heartbeat("b", DAY, 1)
+
+
+def test_only_the_lease_owner_completes(queue, clock):
+    queue.lease("a")
+    clock[0] += 11
+    queue.lease("b")
+
+    assert not queue.complete("a", DAY, 0)
+    assert queue.complete("b", DAY, 0)
+    assert queue.status()["units"] == {"done": 1, "pending": 1}
+
+
+def test_units_fail_after_max_attempts(queue, clock):
+    queue.lease("a")
+    queue.release("a", DAY, 0)
+    assert queue.status()["units"] == {"pending": 2}
+
+    # Second attempt expires: the unit is failed instead of leased again
+    assert queue.lease("b") == (DAY, 0, 2)
+    clock[0] += 11
+    assert queue.lease("c") == (DAY, 1, 2)
+    assert queue.status()["units"] == {"failed": 1, "leased": 1}
+
+
+def test_merge_waits_for_all_shards(queue):
+    for shard in range(2):
+        queue.lease("a")
+        assert queue.lease_merge("m") is None
+        queue.complete("a", DAY, shard)
+
+    assert queue.lease_merge("m") == (DAY, 2)
+    assert queue.lease_merge("n") is None
+    queue.complete_merge("m", DAY)
+    assert queue.status()["days"] == {"merged": 1}
+
+
+def test_merge_fails_after_max_attempts(queue, clock):
+    for shard in range(2):
+        queue.lease("a")
+        queue.complete("a", DAY, shard)
+
+    assert queue.lease_merge("m") == (DAY, 2)
+    queue.release_merge("m", DAY)
+    assert queue.lease_merge("n") == (DAY, 2)
+    clock[0] += 11
+    assert queue.lease_merge("o") is None
+    assert queue.status()["days"] == {"failed": 1}
+
+
+def test_requeue_resets_failed_units_and_days(queue, clock):
+    for worker in ["a", "b"]:
+        queue.lease(worker)
+        queue.release(worker, DAY, 0)
+    assert queue.status()["units"] == {"failed": 1, "pending": 1}
+    assert queue.requeue(start=datetime(2024, 4, 6)) == {"units": 0, "days": 0}
+
+    assert queue.requeue() == {"units": 1, "days": 0}
+    assert queue.status()["units"] == {"pending": 2}
+    # The requeued unit gets max_attempts new attempts
+    for worker in ["c", "d"]:
+        assert queue.lease(worker) == (DAY, 0, 2)
+        queue.release(worker, DAY, 0)
+    assert queue.status()["units"] == {"failed": 1, "pending": 1}
+
+    queue.requeue(start=DAY, stop=DAY)
+    for shard in range(2):
+        queue.lease("a")
+        queue.complete("a", DAY, shard)
+    for worker in ["m", "n"]:
+        queue.lease_merge(worker)
+        queue.release_merge(worker, DAY)
+    assert queue.status()["days"] == {"failed": 1}
+    assert queue.requeue() == {"units": 0, "days": 1}
+    assert queue.lease_merge("o") == (DAY, 2)